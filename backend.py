@@ -0,0 +1,214 @@
+from abc import ABC, abstractmethod
+
+import storage
+
+# ------------------------------
+#  Хранилище общего состояния
+# ------------------------------
+# Всё, что должно быть общим для нескольких процессов бота (пользователи, сделки, диалоги,
+# настройки), читается и пишется через этот интерфейс. Словари в памяти процесса - только кэш,
+# который сбрасывается по журналу изменений (changes_since), а настройки - по их версии
+# (config_version).
+# Методы синхронные: вызывающий код выполняет их в потоке базы данных через storage.run_async.
+# Все методы абстрактные: бэкенд, в котором какого-то не хватает, не создаётся (TypeError).
+
+
+class StateBackend(ABC):
+    @abstractmethod
+    def load_user(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_deal(self, deal_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_conversation(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_username(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_deals_page(self, after=None, before=None, limit=10):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_batch(self, users, deals, deleted_deals, usernames=(), conversations=(), deleted_conversations=()):
+        raise NotImplementedError
+
+    @abstractmethod
+    def settle_deal(self, idempotency_key, deal_id, deal, buyer_id, debit):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_user_stats(self, user_id, balance=None, successful_deals=None, reference=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def take_balance_snapshot(self, keep):
+        raise NotImplementedError
+
+    @abstractmethod
+    def last_snapshot_time(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def expired_deal_ids(self, older_than, limit):
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_deals(self, deal_ids, older_than):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_config(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def config_version(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_config(self, key, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_admin(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_admin(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def purge_conversations(self, older_than):
+        raise NotImplementedError
+
+    @abstractmethod
+    def publish_change(self, kind, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def last_change_id(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def changes_since(self, last_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def purge_changes(self, older_than):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_media(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_media(self, source, fingerprint, file_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_media(self, source):
+        raise NotImplementedError
+
+
+class SQLiteBackend(StateBackend):
+    # Реализация по умолчанию поверх storage.py (одна база SQLite в режиме WAL).
+    # publish_changes включает запись журнала изменений для остальных процессов.
+
+    def __init__(self, publish_changes=False):
+        self.publish_changes = publish_changes
+
+    def load_user(self, user_id):
+        return storage.load_user(user_id)
+
+    def load_deal(self, deal_id):
+        return storage.load_deal(deal_id)
+
+    def load_conversation(self, user_id):
+        return storage.load_conversation(user_id)
+
+    def get_username(self, user_id):
+        return storage.get_username(user_id)
+
+    def get_deals_page(self, after=None, before=None, limit=10):
+        return storage.get_deals_page(after, before, limit)
+
+    def write_batch(self, users, deals, deleted_deals, usernames=(), conversations=(), deleted_conversations=()):
+        storage.write_batch(
+            users, deals, deleted_deals, usernames, conversations, deleted_conversations,
+            publish=self.publish_changes
+        )
+
+    def settle_deal(self, idempotency_key, deal_id, deal, buyer_id, debit):
+        return storage.settle_deal(idempotency_key, deal_id, deal, buyer_id, debit, publish=self.publish_changes)
+
+    def set_user_stats(self, user_id, balance=None, successful_deals=None, reference=None):
+        return storage.set_user_stats(user_id, balance, successful_deals, reference, publish=self.publish_changes)
+
+    def take_balance_snapshot(self, keep):
+        return storage.take_balance_snapshot(keep)
+
+    def last_snapshot_time(self):
+        return storage.last_snapshot_time()
+
+    def expired_deal_ids(self, older_than, limit):
+        return storage.expired_deal_ids(older_than, limit)
+
+    def expire_deals(self, deal_ids, older_than):
+        return storage.expire_deals(deal_ids, older_than, publish=self.publish_changes)
+
+    def load_config(self):
+        return storage.load_config()
+
+    def config_version(self):
+        return storage.config_version()
+
+    def set_config(self, key, value):
+        return storage.set_config(key, value)
+
+    def add_admin(self, user_id):
+        return storage.add_admin(user_id)
+
+    def remove_admin(self, user_id):
+        return storage.remove_admin(user_id)
+
+    def purge_conversations(self, older_than):
+        return storage.purge_conversations(older_than)
+
+    def publish_change(self, kind, key):
+        if self.publish_changes:
+            storage.publish_change(kind, key)
+
+    def last_change_id(self):
+        return storage.last_change_id()
+
+    def changes_since(self, last_id):
+        return storage.changes_since(last_id)
+
+    def purge_changes(self, older_than):
+        return storage.purge_changes(older_than)
+
+    def load_media(self):
+        return storage.load_media()
+
+    def save_media(self, source, fingerprint, file_id):
+        storage.save_media(source, fingerprint, file_id)
+
+    def delete_media(self, source):
+        storage.delete_media(source)
+
+
+_current = SQLiteBackend()
+
+
+def get():
+    return _current
+
+
+def set_backend(state_backend):
+    global _current
+    _current = state_backend
@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import harness
+
+import bot
+import config
+import fanout
+import outbox
+import storage
+from records import Deal, DealStatus
+
+# ------------------------------
+#  Параллельные запросы к Telegram: страница сделок и рассылка админам
+# ------------------------------
+# Ненастоящий Bot API отвечает на каждый запрос через --latency секунд. Замеряется:
+#   - страница сделок: от нажатия admin_view_deals до отправки страницы, на которой
+#     --page-size сделок с ещё не известными username продавцов и покупателей (get_chat);
+#   - рассылка: от ввода описания новой сделки до доставки уведомления всем --admins админам.
+# Каждый замер выполняется дважды: последовательно (по одному запросу за раз, как было раньше)
+# и параллельно (fanout.fan_out и обработчики outbox). Лимиты Bot API (outbox) соблюдаются
+# в обоих случаях; --no-limits их снимает, чтобы увидеть выигрыш от одной только параллельности.
+#
+#   python benchmarks/admin_fanout.py [--page-size 50] [--admins 50] [--latency 0.05] [--no-limits]
+
+_next_user_id = 10 ** 6
+
+
+def fresh_users(count):
+    # Пользователи, username которых бот ещё не видел
+    global _next_user_id
+    _next_user_id += count
+    return list(range(_next_user_id - count, _next_user_id))
+
+
+async def sequential_fan_out(func, items, limit=None):
+    results = []
+    for item in items:
+        try:
+            results.append(await func(item))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+async def wait_sent(request, start, predicate, count=1):
+    # Ждёт, пока среди отправленных после start наберётся count сообщений, подходящих под predicate
+    while sum(1 for sent in request.sent[start:] if predicate(*sent)) < count:
+        await asyncio.sleep(0.001)
+
+
+async def refill():
+    # Ждёт, пока общий лимит Bot API восстановится после прошлого замера
+    await asyncio.sleep(outbox.GLOBAL_BURST / outbox.GLOBAL_RATE)
+
+
+async def deals_page(application, request, page_size):
+    users = fresh_users(2 * page_size)
+    now = int(time.time())
+    deals = [
+        (f"fanout-{users[i]}", Deal(1.0, 'товар', users[i], users[page_size + i], now, DealStatus.JOINED.value))
+        for i in range(page_size)
+    ]
+    await storage.run_async(storage.write_batch, (), deals, ())
+    await refill()
+    start = len(request.sent)
+    started = time.perf_counter()
+    await harness.feed(application, harness.callback_update(harness.ADMIN_ID, 'admin_view_deals'))
+    await wait_sent(request, start, lambda method, chat_id, text: chat_id == harness.ADMIN_ID and text.startswith("Активные сделки"))
+    elapsed = time.perf_counter() - started
+    await storage.run_async(storage.write_batch, (), (), [deal_id for deal_id, _ in deals])
+    return elapsed
+
+
+async def broadcast(application, request, admins):
+    seller_id = fresh_users(1)[0]
+    await harness.feed(application, harness.callback_update(seller_id, 'create_deal'))
+    await harness.feed(application, harness.message_update(seller_id, '5'))
+    await refill()
+    start = len(request.sent)
+    started = time.perf_counter()
+    await harness.feed(application, harness.message_update(seller_id, 'товар'))
+    await wait_sent(request, start, lambda method, chat_id, text: text.startswith("Новая сделка создана"), len(admins))
+    return time.perf_counter() - started
+
+
+async def run(args):
+    harness.use_temp_db()
+    if args.no_limits:
+        harness.unthrottle()
+    request = harness.FakeRequest(args.latency)
+    application = await harness.start(request)
+    bot.DEALS_PAGE_SIZE = args.page_size
+    for admin_id in fresh_users(args.admins - 1):
+        await config.add_admin(admin_id)
+    parallel_fan_out, parallel_workers = fanout.fan_out, outbox.WORKERS
+    results = {}
+    try:
+        for mode, fan_out, workers in (('последовательно', sequential_fan_out, 1), ('параллельно', parallel_fan_out, parallel_workers)):
+            await outbox.close()  # Обработчики очереди запустятся заново с новым WORKERS
+            fanout.fan_out, outbox.WORKERS = fan_out, workers
+            results[mode] = (
+                await deals_page(application, request, args.page_size),
+                await broadcast(application, request, config.admins()),
+            )
+    finally:
+        fanout.fan_out, outbox.WORKERS = parallel_fan_out, parallel_workers
+        await harness.stop(application)
+
+    print(f"Задержка Bot API {args.latency * 1000:.0f} мс, лимиты Bot API {'сняты' if args.no_limits else 'соблюдаются'}")
+    for mode, (page, sent) in results.items():
+        print(f"{mode}: страница из {args.page_size} сделок {page:.2f} с, рассылка {len(config.admins())} админам {sent:.2f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Страница сделок и рассылка админам: последовательно и параллельно")
+    parser.add_argument('--page-size', type=int, default=50, help="сделок на странице")
+    parser.add_argument('--admins', type=int, default=50, help="число админов")
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка ответа Bot API, секунд")
+    parser.add_argument('--no-limits', action='store_true', help="снять лимиты Bot API")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import random
+import time
+from string import Formatter
+
+import harness  # noqa: F401 - путь к модулям бота
+
+import messages
+
+# ------------------------------
+#  Скорость messages.get_text
+# ------------------------------
+# Сравнивает прежний get_text (выбор языка через if/elif, поиск в словаре и str.format
+# на каждый вызов) с реестром шаблонов на нескольких наборах вызовов:
+#   - кнопки: надписи без параметров, как при сборке клавиатур;
+#   - сообщения: тексты с параметрами (сделка, оплата, уведомления);
+#   - обновления: смесь, которую давали обработчики до кэширования клавиатур:
+#     на одно сообщение с параметрами - несколько надписей кнопок.
+# Языки - 70% ru, 30% en. Выводится время одного вызова.
+#
+#   python benchmarks/get_text_bench.py [--calls 200000] [--repeat 5]
+
+
+def legacy_get_text(lang, key, **kwargs):
+    # get_text до реестра шаблонов
+    if lang == 'ru':
+        return messages.RU_TEXTS.get(key, '').format(**kwargs)
+    elif lang == 'en':
+        return messages.EN_TEXTS.get(key, '').format(**kwargs)
+    return ''
+
+
+def _sample_kwargs(key):
+    # Параметры для текста key на любом языке
+    kwargs = {}
+    for texts in (messages.RU_TEXTS, messages.EN_TEXTS):
+        for _, field, _, _ in Formatter().parse(texts.get(key, '')):
+            if field is not None:
+                kwargs[field] = _sample_value(field)
+    return kwargs
+
+
+def _sample_value(field):
+    if 'amount' in field:
+        return 12.5
+    if field.endswith('_id') or field in ('successful_deals', 'days'):
+        return 123456789
+    return f"{field} пользователя"
+
+
+def call_mixes(count, rng):
+    formatted = {key: _sample_kwargs(key) for key in messages.RU_TEXTS if _sample_kwargs(key)}
+    static = [key for key in messages.RU_TEXTS if key not in formatted]
+    buttons = [key for key in static if key.endswith('_button')]
+
+    def lang():
+        return 'ru' if rng.random() < 0.7 else 'en'
+
+    def button_call():
+        return lang(), rng.choice(buttons), {}
+
+    def message_call():
+        key = rng.choice(list(formatted))
+        return lang(), key, formatted[key]
+
+    def update_calls():
+        # Ответ на обновление: текст (с параметрами или без) и кнопки под ним
+        language = lang()
+        key = rng.choice(list(formatted) + static)
+        calls = [(language, key, formatted.get(key, {}))]
+        calls += [(language, rng.choice(buttons), {}) for _ in range(rng.randint(1, 6))]
+        return calls
+
+    updates = []
+    while len(updates) < count:
+        updates.extend(update_calls())
+    return {
+        'кнопки': [button_call() for _ in range(count)],
+        'сообщения': [message_call() for _ in range(count)],
+        'обновления': updates[:count],
+    }
+
+
+def measure(func, calls, repeat):
+    # Лучшее из repeat время одного вызова, секунд
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for lang, key, kwargs in calls:
+            func(lang, key, **kwargs)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость messages.get_text: прежняя реализация и реестр шаблонов")
+    parser.add_argument('--calls', type=int, default=200000, help="вызовов в наборе")
+    parser.add_argument('--repeat', type=int, default=5, help="повторов, берётся лучший")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for name, calls in call_mixes(args.calls, random.Random(args.seed)).items():
+        for lang, key, kwargs in calls[:1000]:
+            if legacy_get_text(lang, key, **kwargs) != messages.get_text(lang, key, **kwargs):
+                raise SystemExit(f"Тексты различаются: {lang} {key}")
+        before = measure(legacy_get_text, calls, args.repeat)
+        after = measure(messages.get_text, calls, args.repeat)
+        print(f"{name}: прежний {before * 1e9:.0f} нс/вызов, реестр {after * 1e9:.0f} нс/вызов, "
+              f"быстрее в {before / after:.1f} раза")
+
+
+if __name__ == "__main__":
+    main()
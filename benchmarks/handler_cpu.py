@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import collections
+import logging
+import random
+import time
+
+import harness
+
+from telegram import Update
+
+import keyboards
+import outbox
+
+# ------------------------------
+#  Процессорное время обработчиков на одно обновление
+# ------------------------------
+# Прогоняет через приложение бота --updates обновлений (/start, кнопки меню, смена языка,
+# ссылка на сделку, создание сделки) и замеряет процессорное время потока event loop
+# на application.process_update каждого из них. Разбор JSON в Update, отправка сообщений
+# очередью outbox и запись в базу в потоке-писателе в замер не входят.
+# Обновления по очереди обрабатываются с кэшированными клавиатурами (keyboards.py)
+# и с клавиатурами, которые собираются заново на каждый вызов, как было раньше.
+#
+#   python benchmarks/handler_cpu.py [--updates 5000] [--users 200]
+
+FIRST_USER_ID = 1000
+SELLERS = 20
+MODES = ('кэш клавиатур', 'без кэша')
+KEYBOARDS = (
+    'menu_keyboard', 'main_keyboard', 'change_lang_keyboard', 'manage_admins_keyboard',
+    'back_to_manage_admins_button', 'back_to_manage_admins_keyboard', 'deal_keyboard',
+)
+
+
+def make_updates(count, users, deal_ids, rng):
+    # [(вид обновления, JSON)]
+    kinds = {
+        '/start': lambda user_id: harness.message_update(user_id, '/start'),
+        'сделка по ссылке': lambda user_id: harness.message_update(user_id, f"/start {rng.choice(deal_ids)}"),
+        'menu': lambda user_id: harness.callback_update(user_id, 'menu'),
+        'wallet': lambda user_id: harness.callback_update(user_id, 'wallet'),
+        'referral': lambda user_id: harness.callback_update(user_id, 'referral'),
+        'change_lang': lambda user_id: harness.callback_update(user_id, 'change_lang'),
+        'lang_*': lambda user_id: harness.callback_update(user_id, rng.choice(('lang_ru', 'lang_en'))),
+        'create_deal': lambda user_id: harness.callback_update(user_id, 'create_deal'),
+        'ввод суммы': lambda user_id: harness.message_update(user_id, str(rng.randint(1, 100))),
+    }
+    names = list(kinds)
+    return [(name, kinds[name](rng.choice(users))) for name in (rng.choice(names) for _ in range(count))]
+
+
+def use_cache(enabled, cached):
+    # Кэшированные клавиатуры или их исходные функции, которые собирают клавиатуру на каждый вызов
+    for name, function in cached.items():
+        setattr(keyboards, name, function if enabled else function.__wrapped__)
+
+
+async def drain():
+    while outbox.size():
+        await asyncio.sleep(0)
+
+
+async def measure(application, updates, cached):
+    # {режим: {вид обновления: [секунды процессорного времени]}}. Режимы чередуются
+    # через одно обновление, чтобы прогрев и рост данных сказывались на них одинаково.
+    times = {mode: collections.defaultdict(list) for mode in MODES}
+    for i, (name, data) in enumerate(updates):
+        mode = MODES[i % len(MODES)]
+        use_cache(mode == MODES[0], cached)
+        update = Update.de_json(data, application.bot)
+        await drain()
+        started = time.thread_time()
+        await application.process_update(update)
+        times[mode][name].append(time.thread_time() - started)
+    return times
+
+
+async def run(args):
+    harness.use_temp_db()
+    harness.unthrottle()
+    request = harness.FakeRequest()
+    application = await harness.start(request)
+    rng = random.Random(args.seed)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    cached = {name: getattr(keyboards, name) for name in KEYBOARDS}
+    try:
+        # Сделки для ссылок
+        for seller_id in range(FIRST_USER_ID - SELLERS, FIRST_USER_ID):
+            await harness.feed(application, harness.callback_update(seller_id, 'create_deal'))
+            await harness.feed(application, harness.message_update(seller_id, '5'))
+            await harness.feed(application, harness.message_update(seller_id, 'товар'))
+        await drain()
+        deals = harness.DealLinks(request)
+        deals.refresh()
+
+        updates = make_updates(args.updates, users, deals.ids, rng)
+        await measure(application, updates[:500], cached)  # Прогрев: кэши пользователей, сделок и клавиатур
+        results = await measure(application, updates, cached)
+    finally:
+        use_cache(True, cached)
+        await harness.stop(application)
+
+    cached_times, rebuilt_times = (results[mode] for mode in MODES)
+    print(f"{'обновление':<18} {'кэш, мкс':>10} {'без кэша, мкс':>14}")
+    for name in sorted(cached_times):
+        print(f"{name:<18} {_mean(cached_times[name]) * 1e6:>10.0f} {_mean(rebuilt_times[name]) * 1e6:>14.0f}")
+    total_cached = _mean([t for values in cached_times.values() for t in values])
+    total_rebuilt = _mean([t for values in rebuilt_times.values() for t in values])
+    print(f"{'в среднем':<18} {total_cached * 1e6:>10.0f} {total_rebuilt * 1e6:>14.0f}")
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Процессорное время обработчиков на одно обновление")
+    parser.add_argument('--updates', type=int, default=5000, help="число обновлений")
+    parser.add_argument('--users', type=int, default=200, help="число пользователей")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
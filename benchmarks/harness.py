@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+# ------------------------------
+#  Бот без сети для нагрузочных скриптов
+# ------------------------------
+# Настоящее приложение (bot.build_application) с обработчиками, очередью отправки и журналом,
+# но с временной базой и ненастоящим Bot API: FakeRequest отвечает на запросы сам,
+# при необходимости с задержкой latency. Обновления собираются в виде JSON, как их присылает
+# Telegram, и передаются в application.process_update.
+ADMIN_ID = 1
+BOT_ID = 999
+TOKEN = f"{BOT_ID}:benchmark"
+
+os.environ.setdefault('ADMIN_IDS', str(ADMIN_ID))
+
+import bot  # noqa: E402
+import journal  # noqa: E402
+import outbox  # noqa: E402
+import storage  # noqa: E402
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+_deal_link = re.compile(r'start=([0-9a-f-]{36})')
+
+
+class FakeRequest(BaseRequest):
+    # Отвечает на методы Bot API, которые вызывает бот; ведёт счётчик вызовов по методам
+    # и список отправленных сообщений sent: [(метод, chat_id, текст)]
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.sent = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data is not None else {}
+        result = self._result(api_method, parameters)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _result(self, api_method, parameters):
+        chat_id = parameters.get('chat_id')
+        if api_method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if api_method == 'getChat':
+            return {
+                'id': chat_id, 'type': 'private', 'username': f"user{chat_id}",
+                'accent_color_id': 0, 'max_reaction_count': 0,
+                'accepted_gift_types': {
+                    'unlimited_gifts': False, 'limited_gifts': False, 'unique_gifts': False,
+                    'premium_subscription': False, 'gifts_from_channels': False,
+                },
+            }
+        if api_method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            text = parameters.get('text', parameters.get('caption', ''))
+            self.sent.append((api_method, chat_id, text))
+            result = _message(chat_id, BOT_ID, text)
+            if api_method == 'sendPhoto':
+                result['photo'] = [{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}]
+            return result
+        return True  # answerCallbackQuery, deleteMessage, setWebhook и т. п.
+
+
+class DealLinks:
+    # Ссылки на созданные сделки из сообщений, которые бот отправил продавцам
+
+    def __init__(self, request):
+        self.request = request
+        self.ids = []
+        self._seen = 0
+
+    def refresh(self):
+        sent = self.request.sent
+        for _, _, text in sent[self._seen:]:
+            match = _deal_link.search(text)
+            if match:
+                self.ids.append(match.group(1))
+        self._seen = len(sent)
+
+
+def use_temp_db():
+    # Вызывается до первого обращения к базе; возвращает путь к файлу базы
+    storage.DB_NAME = os.path.join(tempfile.mkdtemp(prefix='bot-benchmark-'), 'bot_data.db')
+    return storage.DB_NAME
+
+
+def unthrottle():
+    # Снимает лимиты Bot API в очереди отправки: ненастоящему Telegram они не нужны
+    outbox.PER_CHAT_RATE = outbox.PER_CHAT_BURST = outbox.GLOBAL_RATE = outbox.GLOBAL_BURST = 10 ** 9
+    outbox._global_bucket = outbox.TokenBucket(outbox.GLOBAL_RATE, outbox.GLOBAL_BURST)
+
+
+async def start(request=None):
+    # Временная база должна быть уже выбрана (use_temp_db)
+    bot.prepare()
+    application = bot.build_application(TOKEN, request or FakeRequest())
+    await application.initialize()
+    return application
+
+
+async def stop(application):
+    # То же, что делают on_stop и on_shutdown при обычной остановке
+    await outbox.close()
+    await application.shutdown()
+    await journal.close()
+    storage.close_all()
+
+
+async def feed(application, data):
+    await application.process_update(Update.de_json(data, application.bot))
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id}"}
+
+
+def _message(chat_id, from_id, text):
+    return {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': _user(from_id) if from_id != BOT_ID else {'id': BOT_ID, 'is_bot': True, 'first_name': 'Benchmark'},
+        'text': text,
+    }
+
+
+def message_update(user_id, text):
+    # Текстовое сообщение; /команда размечается так же, как у Telegram
+    message = _message(user_id, user_id, text)
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id, data):
+    # Нажатие кнопки под сообщением бота
+    update_id = next(_update_ids)
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': _message(user_id, BOT_ID, 'menu'),
+        },
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import time
+
+import harness
+
+import storage
+
+# ------------------------------
+#  Задержка event loop при медленном диске
+# ------------------------------
+# Каждая запись в базу (функции storage из WRITES) дополнительно "висит на диске"
+# --disk-delay секунд (time.sleep в том потоке, где она выполняется). Пользователи создают сделки,
+# меняют кошелёк и оплачивают чужие сделки, а отдельная задача каждые --tick секунд засыпает
+# и замеряет, насколько позже она проснулась. Пока запись идёт в потоке-писателе, опоздание
+# не зависит от диска и должно быть не больше --max-lag.
+# --blocking выполняет операции с базой прямо в event loop, как до потока-писателя, -
+# тогда опоздание равно задержке диска и проверка не проходит.
+#
+#   python benchmarks/loop_lag.py [--users 20] [--duration 5] [--disk-delay 0.2] [--max-lag 0.05] [--blocking]
+#
+# Код возврата 0 - опоздание в пределах --max-lag, 1 - больше.
+
+FIRST_USER_ID = 1000
+INITIAL_BALANCE = 1000
+WRITES = ('write_batch', 'settle_deal', 'set_user_stats')  # Записи в базу, которые делают обработчики и журнал
+
+
+class SlowDisk:
+    # Подменяет записи storage медленными; writes - число выполненных записей
+
+    def __init__(self, disk_delay):
+        self.disk_delay = disk_delay
+        self.writes = 0
+
+    def install(self):
+        for name in WRITES:
+            setattr(storage, name, self._slow(getattr(storage, name)))
+
+    def _slow(self, func):
+        def write(*args, **kwargs):
+            time.sleep(self.disk_delay)
+            self.writes += 1
+            return func(*args, **kwargs)
+        return write
+
+
+async def run_inline(func, *args):
+    # storage.run_async без потока-писателя
+    return func(*args)
+
+
+async def act(application, user_id, deadline, deals, rng):
+    loop = asyncio.get_running_loop()
+    while loop.time() < deadline:
+        deals.refresh()
+        choice = rng.random()
+        if deals.ids and choice < 0.4:
+            deal_id = rng.choice(deals.ids)
+            await harness.feed(application, harness.message_update(user_id, f"/start {deal_id}"))
+            await harness.feed(application, harness.callback_update(user_id, f"pay_from_balance_{deal_id}"))
+        elif choice < 0.7:
+            await harness.feed(application, harness.callback_update(user_id, 'wallet'))
+            await harness.feed(application, harness.message_update(user_id, f"UQ{rng.randrange(10 ** 9)}"))
+        else:
+            await harness.feed(application, harness.callback_update(user_id, 'create_deal'))
+            await harness.feed(application, harness.message_update(user_id, str(rng.randint(1, 10))))
+            await harness.feed(application, harness.message_update(user_id, f"товар {rng.randrange(10 ** 6)}"))
+
+
+async def measure_lag(tick, deadline, lags):
+    loop = asyncio.get_running_loop()
+    while loop.time() < deadline:
+        started = loop.time()
+        await asyncio.sleep(tick)
+        lags.append(loop.time() - started - tick)
+
+
+async def run(args):
+    harness.use_temp_db()
+    harness.unthrottle()
+    if args.blocking:
+        storage.run_async = run_inline
+    request = harness.FakeRequest(args.latency)
+    application = await harness.start(request)
+    slow_disk = SlowDisk(args.disk_delay)
+    slow_disk.install()
+    rng = random.Random(args.seed)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    deals = harness.DealLinks(request)
+    lags = []
+    try:
+        for user_id in users:
+            await harness.feed(application, harness.callback_update(harness.ADMIN_ID, 'admin_change_balance'))
+            await harness.feed(application, harness.message_update(harness.ADMIN_ID, f"{user_id} {INITIAL_BALANCE}"))
+        deadline = asyncio.get_running_loop().time() + args.duration
+        await asyncio.gather(
+            measure_lag(args.tick, deadline, lags),
+            *(act(application, user_id, deadline, deals, random.Random(rng.random())) for user_id in users)
+        )
+    finally:
+        await harness.stop(application)
+
+    lag = max(lags, default=0.0)
+    print(f"Записей в базу: {slow_disk.writes} по {args.disk_delay * 1000:.0f} мс, "
+          f"запросов к Bot API: {sum(request.calls.values())}")
+    print(f"Опоздание event loop: p50 {harness.percentile(lags, 0.5) * 1000:.1f} мс, "
+          f"p99 {harness.percentile(lags, 0.99) * 1000:.1f} мс, max {lag * 1000:.1f} мс "
+          f"(допустимо {args.max_lag * 1000:.0f} мс)")
+    return lag <= args.max_lag
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка event loop при медленной записи в базу")
+    parser.add_argument('--users', type=int, default=20, help="число пользователей")
+    parser.add_argument('--duration', type=float, default=5.0, help="длительность нагрузки, секунд")
+    parser.add_argument('--disk-delay', type=float, default=0.2, help="задержка каждой записи в базу, секунд")
+    parser.add_argument('--tick', type=float, default=0.01, help="период замера, секунд")
+    parser.add_argument('--max-lag', type=float, default=0.05, help="допустимое опоздание, секунд")
+    parser.add_argument('--latency', type=float, default=0.001, help="задержка ответа Bot API, секунд")
+    parser.add_argument('--blocking', action='store_true', help="операции с базой в event loop (для сравнения)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
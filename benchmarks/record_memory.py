@@ -0,0 +1,77 @@
+import argparse
+import gc
+import tracemalloc
+
+import harness  # noqa: F401 - путь к модулям бота
+
+from records import Deal, User
+
+# ------------------------------
+#  Память записей: словари и классы со __slots__
+# ------------------------------
+# Для каждого размера из --sizes создаёт столько пользователей и сделок двумя способами:
+# словарями с теми же ключами (как раньше хранились user_data и deals) и записями
+# records.User / records.Deal. Значения полей создаются заранее и одни и те же для обоих
+# способов, поэтому tracemalloc считает только сами контейнеры записей.
+#
+#   python benchmarks/record_memory.py [--sizes 100000 1000000]
+
+
+def user_values(count):
+    return [(f"UQ{i:046d}", i * 0.5, i, 'ru' if i % 3 else 'en') for i in range(count)]
+
+
+def deal_values(count):
+    return [(i * 1.5, f"товар {i}", 10 ** 6 + i, 2 * 10 ** 6 + i, 1700000000 + i, 'open') for i in range(count)]
+
+
+def user_dicts(values):
+    return [{'wallet': wallet, 'balance': balance, 'successful_deals': successful_deals, 'lang': lang}
+            for wallet, balance, successful_deals, lang in values]
+
+
+def user_records(values):
+    return [User(wallet, balance, successful_deals, lang) for wallet, balance, successful_deals, lang in values]
+
+
+def deal_dicts(values):
+    return [{'amount': amount, 'description': description, 'seller_id': seller_id, 'buyer_id': buyer_id,
+             'created_at': created_at, 'status': status}
+            for amount, description, seller_id, buyer_id, created_at, status in values]
+
+
+def deal_records(values):
+    return [Deal(amount, description, seller_id, buyer_id, created_at, status)
+            for amount, description, seller_id, buyer_id, created_at, status in values]
+
+
+def measure(build, values):
+    # Байт на запись (вместе с местом в списке)
+    gc.collect()
+    tracemalloc.start()
+    records = build(values)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size / len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Память записей пользователей и сделок: dict и __slots__")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help="число записей")
+    args = parser.parse_args()
+
+    for count in args.sizes:
+        for name, values, as_dicts, as_records in (
+            ('пользователи', user_values(count), user_dicts, user_records),
+            ('сделки', deal_values(count), deal_dicts, deal_records),
+        ):
+            dict_size = measure(as_dicts, values)
+            record_size = measure(as_records, values)
+            print(f"{count} {name}: dict {dict_size:.0f} Б/запись ({dict_size * count / 2 ** 20:.0f} МБ), "
+                  f"__slots__ {record_size:.0f} Б/запись ({record_size * count / 2 ** 20:.0f} МБ), "
+                  f"в {dict_size / record_size:.1f} раза меньше")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import harness  # noqa: F401 - путь к модулям бота
+
+import bot
+import storage
+
+# ------------------------------
+#  Время запуска и память: ленивая загрузка и полная
+# ------------------------------
+# Создаёт базу с --users пользователями и --deals сделками (или берёт готовую --db) и для
+# LAZY_LOADING=1 и LAZY_LOADING=0 запускает отдельный процесс, который выполняет подготовку
+# бота (bot.prepare: схема, настройки, загрузка данных) и затем --accesses раз обращается
+# к случайным пользователям так, как это делает track_user. Выводятся время подготовки,
+# время одного обращения, память процесса (RSS) после подготовки и пиковая.
+#
+#   python benchmarks/startup.py [--users 1000000] [--deals 100000] [--accesses 1000] [--db путь]
+
+BATCH = 100000
+
+
+def create_db(path, users, deals):
+    storage.DB_NAME = path
+    bot.init_db()
+    conn = storage.get_connection()
+    for start in range(0, users, BATCH):
+        conn.executemany('INSERT INTO users (user_id, wallet, balance, lang) VALUES (?, ?, ?, ?)', (
+            (user_id, f"UQ{user_id}", storage.to_minor(user_id % 1000), 'ru' if user_id % 3 else 'en')
+            for user_id in range(start + 1, min(start + BATCH, users) + 1)
+        ))
+        conn.commit()
+    now = int(time.time())
+    conn.executemany(
+        'INSERT INTO deals (deal_id, amount, description, seller_id, buyer_id, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        ((f"deal-{i}", storage.to_minor(1.5), f"товар {i}", i % users + 1, None, 'open', now, now) for i in range(deals))
+    )
+    conn.commit()
+    storage.close_all()
+
+
+def _rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def child(path, users, accesses):
+    # Отдельный процесс: режим загрузки задаёт переменная окружения LAZY_LOADING
+    storage.DB_NAME = path
+    rss_before = _rss()
+    started = time.perf_counter()
+    bot.prepare()
+    prepare_time = time.perf_counter() - started
+    rss_after = _rss()
+
+    async def access(user_ids):
+        for user_id in user_ids:
+            await bot.user_data.prefetch(user_id)
+            bot.get_lang(user_id)
+
+    rng = random.Random(1)
+    user_ids = [rng.randint(1, users) for _ in range(accesses)]
+    started = time.perf_counter()
+    asyncio.run(access(user_ids))
+    access_time = (time.perf_counter() - started) / max(accesses, 1)
+    storage.close_all()
+    print(json.dumps({
+        'prepare': prepare_time,
+        'access': access_time,
+        'rss': rss_after - rss_before,
+        'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время запуска и память бота с ленивой и полной загрузкой")
+    parser.add_argument('--users', type=int, default=1000000, help="пользователей в базе")
+    parser.add_argument('--deals', type=int, default=100000, help="активных сделок в базе")
+    parser.add_argument('--accesses', type=int, default=1000, help="обращений к случайным пользователям после запуска")
+    parser.add_argument('--db', help="готовая база (по умолчанию создаётся временная)")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.db, args.users, args.accesses)
+        return
+
+    path = args.db
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='bot-benchmark-'), 'bot_data.db')
+        started = time.perf_counter()
+        create_db(path, args.users, args.deals)
+        print(f"База: {args.users} пользователей, {args.deals} сделок, "
+              f"{os.path.getsize(path) / 2 ** 20:.0f} МБ, создана за {time.perf_counter() - started:.1f} с")
+
+    for lazy, name in (('1', 'ленивая загрузка'), ('0', 'полная загрузка')):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', '--db', path, '--users', str(args.users), '--accesses', str(args.accesses)],
+            env={**os.environ, 'LAZY_LOADING': lazy}, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{name}: подготовка {result['prepare']:.2f} с, обращение {result['access'] * 1e6:.0f} мкс, "
+              f"RSS +{result['rss'] / 2 ** 20:.0f} МБ, пик {result['peak'] / 2 ** 20:.0f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import harness
+
+import bot
+import storage
+from records import Deal, User
+
+# ------------------------------
+#  Записи в базу при оплате сделки: до и после storage.py
+# ------------------------------
+# Проводит --payments оплат (pay_from_balance_) двумя способами и выводит оплаты и транзакции в секунду:
+#   - до: как раньше делал bot.py - списание у покупателя, зачисление продавцу, счётчик успешных
+#     сделок и удаление сделки, каждое через sqlite3.connect / execute / commit / close
+#     (режим журнала по умолчанию, fsync на каждый commit);
+#   - после: storage.settle_deal - одна транзакция на долгоживущем соединении в режиме WAL
+#     с подготовленными запросами, хотя в неё входят ещё запись о расчёте, журнал переводов
+#     и перенос сделки в историю.
+# Обе базы - временные файлы на одном диске.
+#
+#   python benchmarks/storage_writes.py [--payments 2000] [--users 1000]
+
+BEFORE_SCHEMA = (
+    'CREATE TABLE users (user_id INTEGER PRIMARY KEY, wallet TEXT, balance REAL, successful_deals INTEGER, lang TEXT)',
+    'CREATE TABLE deals (deal_id TEXT PRIMARY KEY, amount REAL, description TEXT, seller_id INTEGER, buyer_id INTEGER)',
+)
+INITIAL_BALANCE = 10 ** 6
+AMOUNT = 1.5
+
+
+def _payments(count, users):
+    # (deal_id, покупатель, продавец)
+    return [(f"deal{i}", users[i % len(users)], users[(i + 1) % len(users)]) for i in range(count)]
+
+
+def _execute(db_path, sql, params):
+    # Одна операция так, как её выполнял старый bot.py
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def run_before(db_path, payments, users):
+    conn = sqlite3.connect(db_path)
+    for sql in BEFORE_SCHEMA:
+        conn.execute(sql)
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?)', [(user_id, '', INITIAL_BALANCE, 0, 'ru') for user_id in users])
+    conn.executemany('INSERT INTO deals VALUES (?, ?, ?, ?, ?)', [(deal_id, AMOUNT, 'товар', seller_id, None) for deal_id, _, seller_id in payments])
+    conn.commit()
+    conn.close()
+
+    balances = dict.fromkeys(users, float(INITIAL_BALANCE))
+    successful_deals = dict.fromkeys(users, 0)
+    save_user = 'INSERT OR REPLACE INTO users (user_id, wallet, balance, successful_deals, lang) VALUES (?, ?, ?, ?, ?)'
+    started = time.perf_counter()
+    for deal_id, buyer_id, seller_id in payments:
+        balances[buyer_id] -= AMOUNT
+        _execute(db_path, save_user, (buyer_id, '', balances[buyer_id], successful_deals[buyer_id], 'ru'))
+        balances[seller_id] += AMOUNT
+        _execute(db_path, save_user, (seller_id, '', balances[seller_id], successful_deals[seller_id], 'ru'))
+        successful_deals[seller_id] += 1
+        _execute(db_path, save_user, (seller_id, '', balances[seller_id], successful_deals[seller_id], 'ru'))
+        _execute(db_path, 'DELETE FROM deals WHERE deal_id = ?', (deal_id,))
+    return time.perf_counter() - started, 4
+
+
+def run_after(payments, users):
+    harness.use_temp_db()
+    bot.init_db()
+    deals = {deal_id: Deal(AMOUNT, 'товар', seller_id, None, int(time.time())) for deal_id, _, seller_id in payments}
+    storage.write_batch([(user_id, User()) for user_id in users], list(deals.items()), ())
+    for user_id in users:
+        storage.set_user_stats(user_id, INITIAL_BALANCE)
+
+    started = time.perf_counter()
+    for deal_id, buyer_id, _ in payments:
+        status, _ = storage.settle_deal(f"q{deal_id}", deal_id, deals[deal_id], buyer_id, AMOUNT)
+        if status != 'settled':
+            raise RuntimeError(f"Сделка {deal_id}: {status}")
+    elapsed = time.perf_counter() - started
+    storage.close_all()
+    return elapsed, 1
+
+
+def report(name, elapsed, payments, transactions):
+    print(f"{name}: {payments / elapsed:.0f} оплат/с, {payments * transactions / elapsed:.0f} транзакций/с "
+          f"({transactions} на оплату, {elapsed:.2f} с)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Записи в базу при оплате сделки до и после storage.py")
+    parser.add_argument('--payments', type=int, default=2000, help="число оплат")
+    parser.add_argument('--users', type=int, default=1000, help="число пользователей")
+    args = parser.parse_args()
+
+    users = list(range(1000, 1000 + args.users))
+    payments = _payments(args.payments, users)
+    before_path = os.path.join(tempfile.mkdtemp(prefix='bot-benchmark-'), 'before.db')
+    before, before_transactions = run_before(before_path, payments, users)
+    after, after_transactions = run_after(payments, users)
+    report("До (connect/commit/close на операцию)", before, args.payments, before_transactions)
+    report("После (storage.settle_deal)", after, args.payments, after_transactions)
+    print(f"Ускорение оплаты: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import collections
+import logging
+import random
+import sqlite3
+import sys
+import time
+
+import harness
+
+import bot
+import storage
+import verify_ledger
+from records import DealStatus
+
+# ------------------------------
+#  Стресс-тест параллельной обработки обновлений
+# ------------------------------
+# --users пользователей получают от админа одинаковый баланс, затем все одновременно
+# --rounds раз создают сделку (create_deal -> сумма -> описание, состояние awaiting_description)
+# или покупают чужую: открывают ссылку и дважды подряд жмут pay_from_balance_, пока ту же сделку
+# могут оплачивать другие. Все обновления обрабатываются параллельно (как с CONCURRENT_UPDATES);
+# задержка ответа Bot API (--latency) перемешивает их так же, как настоящая сеть.
+# После остановки проверяется, что деньги не появились и не пропали:
+#   - сумма балансов равна выданной админом, отрицательных балансов нет;
+#   - баланс каждого = выдано - оплачено им + получено за его сделки (по deal_history);
+#   - каждая сделка оплачена не больше одного раза;
+#   - журнал переводов сходится с балансами (verify_ledger);
+#   - балансы в памяти бота совпадают с базой.
+#
+#   python benchmarks/stress_concurrency.py [--users 200] [--rounds 20] [--latency 0.001] [--seed 1]
+#
+# Код возврата 0 - нарушений нет, 1 - найдены нарушения.
+
+FIRST_USER_ID = 1000
+INITIAL_BALANCE = 50
+AMOUNTS = (0.5, 1, 2.5, 7.25, 10)
+
+async def fund(application, users):
+    # Баланс выдаёт админ через диалог admin_change_balance
+    for user_id in users:
+        await harness.feed(application, harness.callback_update(harness.ADMIN_ID, 'admin_change_balance'))
+        await harness.feed(application, harness.message_update(harness.ADMIN_ID, f"{user_id} {INITIAL_BALANCE}"))
+
+
+async def sell(application, user_id, rng):
+    await harness.feed(application, harness.callback_update(user_id, 'create_deal'))
+    await harness.feed(application, harness.message_update(user_id, str(rng.choice(AMOUNTS))))
+    await harness.feed(application, harness.message_update(user_id, f"товар {rng.randrange(10 ** 6)}"))
+
+
+async def buy(application, user_id, deal_id):
+    await harness.feed(application, harness.message_update(user_id, f"/start {deal_id}"))
+    # Двойное нажатие: два разных callback-запроса на одну сделку
+    await asyncio.gather(
+        harness.feed(application, harness.callback_update(user_id, f"pay_from_balance_{deal_id}")),
+        harness.feed(application, harness.callback_update(user_id, f"pay_from_balance_{deal_id}")),
+    )
+
+
+async def act(application, user_id, rounds, deals, actions, rng):
+    # Каждое действие - три обновления
+    for _ in range(rounds):
+        deals.refresh()
+        if deals.ids and rng.random() < 0.6:
+            await buy(application, user_id, rng.choice(deals.ids[-50:]))  # Свежие сделки - больше столкновений
+            actions['buy'] += 1
+        else:
+            await sell(application, user_id, rng)
+            actions['sell'] += 1
+
+
+def check(db_path, users):
+    # Возвращает число нарушений
+    conn = sqlite3.connect(db_path)
+    violations = 0
+    try:
+        balances = dict(conn.execute('SELECT user_id, balance FROM users'))
+        funded = storage.to_minor(INITIAL_BALANCE)
+        total = sum(balances.get(user_id, 0) for user_id in users)
+        if total != funded * len(users):
+            print(f"Сумма балансов {storage.from_minor(total)}, выдано {storage.from_minor(funded * len(users))}")
+            violations += 1
+
+        expected = dict.fromkeys(users, funded)
+        paid = conn.execute('SELECT buyer_id, seller_id, amount FROM deal_history WHERE status = ?', (DealStatus.PAID.value,)).fetchall()
+        for buyer_id, seller_id, amount in paid:
+            expected[buyer_id] -= amount
+            expected[seller_id] += amount
+        for user_id in users:
+            balance = balances.get(user_id, 0)
+            if balance < 0 or balance != expected[user_id]:
+                print(f"Пользователь {user_id}: баланс {storage.from_minor(balance)}, ожидалось {storage.from_minor(expected[user_id])}")
+                violations += 1
+            cached = bot.user_data.get(user_id)
+            if cached is not None and storage.to_minor(cached.balance) != balance:
+                print(f"Пользователь {user_id}: в памяти {cached.balance}, в базе {storage.from_minor(balance)}")
+                violations += 1
+
+        settlements = conn.execute('SELECT COUNT(*), COUNT(DISTINCT deal_id) FROM settlements').fetchone()
+        if settlements[0] != settlements[1] or settlements[0] != len(paid):
+            print(f"Расчётов {settlements[0]}, сделок в них {settlements[1]}, оплаченных сделок {len(paid)}")
+            violations += 1
+
+        violations += verify_ledger.verify(conn, full=True)
+        print(f"Оплачено сделок: {len(paid)}, осталось активных: {conn.execute('SELECT COUNT(*) FROM deals').fetchone()[0]}")
+    finally:
+        conn.close()
+    return violations
+
+
+async def run(args):
+    db_path = harness.use_temp_db()
+    harness.unthrottle()
+    request = harness.FakeRequest(args.latency)
+    application = await harness.start(request)
+    rng = random.Random(args.seed)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    deals = harness.DealLinks(request)
+    actions = collections.Counter()
+    try:
+        await fund(application, users)
+        started = time.perf_counter()
+        await asyncio.gather(*(act(application, user_id, args.rounds, deals, actions, random.Random(rng.random())) for user_id in users))
+        elapsed = time.perf_counter() - started
+    finally:
+        await harness.stop(application)
+    print(f"Обработано обновлений: {3 * args.rounds * args.users} за {elapsed:.1f} с, "
+          f"создано сделок: {actions['sell']}, покупок: {actions['buy']}")
+    return check(db_path, users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стресс-тест параллельной оплаты и создания сделок")
+    parser.add_argument('--users', type=int, default=200, help="число пользователей")
+    parser.add_argument('--rounds', type=int, default=20, help="действий на пользователя")
+    parser.add_argument('--latency', type=float, default=0.001, help="задержка ответа Bot API, секунд")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    violations = asyncio.run(run(args))
+    print("Нарушений нет" if not violations else f"Нарушений: {violations}")
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
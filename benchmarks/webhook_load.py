@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+
+import harness
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot
+
+# ------------------------------
+#  Нагрузочный тест режима webhook
+# ------------------------------
+# Запускает бота с webhook-сервером на --listen:--port (путь и секрет - WEBHOOK_PATH и
+# WEBHOOK_SECRET, как у бота) и ненастоящим Bot API, затем --connections клиентов
+# отправляют POST-запросы с --updates синтетическими обновлениями: /start, кнопки меню,
+# смена кошелька, создание сделки. Выводятся p50/p99:
+#   - ответа webhook (обновление принято в очередь);
+#   - обработки: от отправки запроса до завершения обработчиков этого обновления.
+# Клиенты работают в том же процессе, что и бот, через простые keep-alive соединения,
+# чтобы как можно меньше отнимать у него процессорного времени.
+# Нужен pip install "python-telegram-bot[webhooks]".
+#
+#   python benchmarks/webhook_load.py [--updates 5000] [--connections 32] [--concurrent-updates 16] [--latency 0.02]
+
+BUTTONS = ('menu', 'wallet', 'referral', 'change_lang', 'create_deal')
+
+
+def make_update(rng, users):
+    user_id = rng.choice(users)
+    choice = rng.random()
+    if choice < 0.2:
+        return harness.message_update(user_id, '/start')
+    if choice < 0.8:
+        return harness.callback_update(user_id, rng.choice(BUTTONS))
+    return harness.message_update(user_id, f"UQ{rng.randrange(10 ** 9)}")  # Ввод кошелька или суммы
+
+
+async def post(reader, writer, request_head, update):
+    # Один POST по keep-alive соединению; возвращает код ответа
+    body = json.dumps(update).encode()
+    writer.write(request_head + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+def report(name, values):
+    print(f"{name}: p50 {harness.percentile(values, 0.5) * 1000:.1f} мс, "
+          f"p99 {harness.percentile(values, 0.99) * 1000:.1f} мс, max {max(values, default=0.0) * 1000:.1f} мс")
+
+
+async def run(args):
+    harness.use_temp_db()
+    harness.unthrottle()
+    bot.CONCURRENT_UPDATES = args.concurrent_updates
+    application = await harness.start(harness.FakeRequest(args.latency))
+
+    # Обработка обновления закончена, когда до него доходит последняя группа обработчиков
+    handled = {}
+    waiters = {}
+
+    async def mark_handled(update, context):
+        handled[update.update_id] = time.perf_counter()
+        waiter = waiters.pop(update.update_id, None)
+        if waiter is not None:
+            waiter.set_result(None)
+    application.add_handler(TypeHandler(Update, mark_handled), group=100)
+
+    await application.start()
+    await application.updater.start_webhook(
+        listen=args.listen,
+        port=args.port,
+        url_path=bot.WEBHOOK_PATH,
+        webhook_url=f"http://{args.listen}:{args.port}/{bot.WEBHOOK_PATH}",
+        secret_token=bot.WEBHOOK_SECRET
+    )
+    secret = f"X-Telegram-Bot-Api-Secret-Token: {bot.WEBHOOK_SECRET}\r\n" if bot.WEBHOOK_SECRET else ''
+    request_head = (
+        f"POST /{bot.WEBHOOK_PATH} HTTP/1.1\r\nHost: {args.listen}:{args.port}\r\n"
+        f"Content-Type: application/json\r\n{secret}"
+    ).encode()
+
+    rng = random.Random(args.seed)
+    users = list(range(1000, 1000 + args.users))
+    updates = [make_update(rng, users) for _ in range(args.updates)]
+    responses = []
+    latencies = []
+    failed = 0
+
+    async def client(queue):
+        nonlocal failed
+        loop = asyncio.get_running_loop()
+        reader, writer = await asyncio.open_connection(args.listen, args.port)
+        try:
+            while queue:
+                update = queue.pop()
+                waiter = waiters[update['update_id']] = loop.create_future()
+                posted = time.perf_counter()
+                status = await post(reader, writer, request_head, update)
+                responses.append(time.perf_counter() - posted)
+                if status != 200:
+                    failed += 1
+                    waiters.pop(update['update_id'], None)
+                    continue
+                await waiter
+                latencies.append(handled[update['update_id']] - posted)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    try:
+        queue = updates[::-1]
+        await asyncio.gather(*(client(queue) for _ in range(args.connections)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await harness.stop(application)
+
+    print(f"Обновлений: {len(updates)} за {elapsed:.1f} с ({len(updates) / elapsed:.0f}/с), "
+          f"соединений: {args.connections}, concurrent_updates: {args.concurrent_updates}, ошибок: {failed}")
+    report("Ответ webhook", responses)
+    report("Обработка", latencies)
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест webhook-сервера бота")
+    parser.add_argument('--updates', type=int, default=5000, help="сколько обновлений отправить")
+    parser.add_argument('--connections', type=int, default=32, help="одновременных соединений")
+    parser.add_argument('--concurrent-updates', type=int, default=16, help="CONCURRENT_UPDATES бота")
+    parser.add_argument('--users', type=int, default=500, help="число разных пользователей")
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка ответа Bot API, секунд")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,181 +1,154 @@
-import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes, TypeHandler
+import asyncio
 import uuid
+import time
 import logging
 import os
+import storage
+import backend
+import journal
+import locks
+import usernames
+import fanout
+import outbox
+import media
+import metrics
+import logs
+import keyboards
+import router
+import conversation
+import config
+import migrations
+from lazy import LazyTable
+from records import User, Deal, DealStatus, snapshot
 from messages import get_text  # Импортируем функцию для получения текста
 
 # Настройка логгера
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler('bot.log'),  # Запись в файл
-        logging.StreamHandler()         # Вывод в консоль
-    ]
-)
-
 logger = logging.getLogger(__name__)
 
 # Конфигурация бота
 BOT_TOKEN = ""  # Замените на ваш токен
-ADMIN_IDS = {}  # Множество ID администраторов
-VALUTE = "TON"  # По умолчанию валюта - TON
+# ID первых администраторов через запятую; добавляются, только если в базе ещё нет ни одного.
+# Валюта и список админов дальше хранятся в базе (см. config.py).
+INITIAL_ADMIN_IDS = [int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id.strip()]
+
+# Картинка главного меню и создания сделки: URL или путь к файлу. После первой отправки
+# используется file_id от Telegram (см. media.py). Если задан MEDIA_UPLOAD_CHAT_ID, картинка
+# загружается при запуске в этот чат (например, личный чат админа) и сразу удаляется.
+START_PHOTO = os.getenv('START_PHOTO', 'https://postimg.cc/8sHq27HV')
+MEDIA_UPLOAD_CHAT_ID = int(os.getenv('MEDIA_UPLOAD_CHAT_ID', '0')) or None
+
+# Логи: в файл LOG_FILE (JSON по строке на запись) и в консоль, запись идёт в отдельном потоке.
+# Файл ротируется по размеру LOG_MAX_BYTES, хранится LOG_BACKUP_COUNT сжатых частей.
+# LOG_SAMPLE_LEVEL (например INFO) включает прореживание: записи этого уровня и ниже
+# сохраняются с вероятностью LOG_SAMPLE_RATE.
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_SAMPLE_LEVEL = getattr(logging, os.getenv('LOG_SAMPLE_LEVEL', '').upper(), None)
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+
+# Метрики в формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics (0 - выключены)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Публичный адрес бота, например https://example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')  # Адрес локального HTTP-сервера
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Сколько обновлений обрабатывать одновременно (1 - по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '1'))
+
+# Несколько процессов бота с общей базой: изменения публикуются в журнал changes,
+# и каждый процесс раз в STATE_SYNC_INTERVAL секунд сбрасывает у себя изменённые записи
+SHARED_STATE = os.getenv('SHARED_STATE', '0') == '1'
+STATE_SYNC_INTERVAL = float(os.getenv('STATE_SYNC_INTERVAL', '1.0'))
+CHANGES_RETENTION = 60 * 60  # Сколько секунд хранить записи журнала изменений
+
+# Ленивая загрузка: пользователи и сделки читаются из базы при первом обращении,
+# в памяти держится ограниченное число записей. LAZY_LOADING=0 - всё загружается при запуске.
+LAZY_LOADING = os.getenv('LAZY_LOADING', '1') == '1'
+USER_CACHE_SIZE = 100000  # Максимум пользователей в памяти
+DEAL_CACHE_SIZE = 10000  # Максимум сделок в памяти
 
 # Хранение данных
-user_data = {}  # Данные пользователей: {user_id: {'wallet': 'адрес', 'balance': float, 'successful_deals': int, 'lang': 'ru'}}
-deals = {}  # Сделки: {deal_id: {'amount': float, 'description': str, 'seller_id': int, 'buyer_id': int}}
-admin_commands = {}  # Команды админа: {user_id: 'command'}
+# Данные пользователей: {user_id: User}
+user_data = LazyTable(lambda user_id: backend.get().load_user(user_id), journal.pending_user, USER_CACHE_SIZE if LAZY_LOADING else None)
+# Сделки: {deal_id: Deal}
+deals = LazyTable(lambda deal_id: backend.get().load_deal(deal_id), journal.pending_deal, DEAL_CACHE_SIZE if LAZY_LOADING else None)
 
 # Подключение к базе данных
-DB_NAME = 'bot_data.db'
+DB_NAME = storage.DB_NAME
+
+# Количество сделок на одной странице админ-просмотра
+DEALS_PAGE_SIZE = 10
+# Сколько символов описания показывать в списке сделок: страница из DEALS_PAGE_SIZE сделок
+# с полными описаниями не помещается в одно сообщение Telegram (4096 символов)
+DEAL_DESCRIPTION_PREVIEW = 100
+
+# Максимальная сумма сделки и баланс, который может задать админ: в базе суммы - целые
+# минимальные единицы (storage.MINOR_UNITS) и должны помещаться в 64-битное целое SQLite
+MAX_DEAL_AMOUNT = 10 ** 9
+MAX_BALANCE = 10 ** 9
+MAX_USER_ID = 2 ** 52  # ID пользователей Telegram занимают не больше 52 бит
+MAX_SUCCESSFUL_DEALS = 10 ** 9
+
+# Отмена брошенных сделок: сделки, к которым за DEAL_TTL_DAYS дней не присоединился покупатель,
+# переносятся в историю со статусом cancelled. Работает на JobQueue
+# (pip install "python-telegram-bot[job-queue]").
+DEAL_TTL_DAYS = float(os.getenv('DEAL_TTL_DAYS', '7'))
+DEAL_SWEEP_INTERVAL = 10 * 60  # Секунд между проходами
+DEAL_SWEEP_BATCH = 200  # Сделок в одной транзакции
+DEAL_SWEEP_MAX_BATCHES = 50  # Транзакций за один проход, остальное - в следующий раз
+
+# Снимки балансов по журналу переводов (тоже на JobQueue): проверка журнала
+# (verify_ledger.py) начинается с последнего снимка
+BALANCE_SNAPSHOT_INTERVAL = 24 * 60 * 60  # Секунд между снимками
+BALANCE_SNAPSHOTS_KEPT = 7  # Сколько последних снимков хранить
+BALANCE_SNAPSHOT_MIN_DELAY = 60  # Не раньше чем через столько секунд после запуска
 
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    # Создаем таблицу users, если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            wallet TEXT,
-            balance REAL,
-            successful_deals INTEGER,
-            lang TEXT
-        )
-    ''')
-
-    # Создаем таблицу admins, если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS admins (
-            user_id INTEGER PRIMARY KEY
-        )
-    ''')
-
-    # Проверяем, существует ли столбец lang в таблице users
-    cursor.execute("PRAGMA table_info(users)")
-    columns = cursor.fetchall()
-    column_names = [column[1] for column in columns]  # Получаем список имен столбцов
-
-    if 'lang' not in column_names:
-        # Добавляем столбец lang, если его нет
-        cursor.execute('ALTER TABLE users ADD COLUMN lang TEXT DEFAULT "ru"')
-
-    # Создаем таблицу deals, если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS deals (
-            deal_id TEXT PRIMARY KEY,
-            amount REAL,
-            description TEXT,
-            seller_id INTEGER,
-            buyer_id INTEGER
-        )
-    ''')
+    conn = storage.get_connection()
+    migrations.run(conn)  # Создание и обновление схемы (см. migrations.py)
 
-    # Добавляем первого администратора, если таблица пуста
-    cursor.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (1805496851,))
+    cursor = conn.cursor()
 
-    # Загружаем администраторов из базы данных
-    cursor.execute('SELECT user_id FROM admins')
-    admin_ids = cursor.fetchall()
-    for admin_id in admin_ids:
-        ADMIN_IDS.add(admin_id[0])
+    # Добавляем первых администраторов, если таблица пуста
+    if cursor.execute('SELECT 1 FROM admins LIMIT 1').fetchone() is None:
+        cursor.executemany('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', [(admin_id,) for admin_id in INITIAL_ADMIN_IDS])
+        cursor.execute(storage.SQL_SET_CONFIG, ('admins', None))
 
     conn.commit()
-    conn.close()
 
 
 def load_data():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    conn = storage.get_connection()
 
     # Загрузка данных о пользователях
-    cursor.execute('SELECT * FROM users')
-    rows = cursor.fetchall()
-    for row in rows:
-        user_id, wallet, balance, successful_deals, lang = row
-        user_data[user_id] = {
-            'wallet': wallet,
-            'balance': balance,
-            'successful_deals': successful_deals,
-            'lang': lang or 'ru'  # По умолчанию язык - русский
-        }
+    user_data.load((row[0], storage.user_from_row(row)) for row in conn.execute(storage.SQL_LOAD_USERS))
 
     # Загрузка данных о сделках
-    cursor.execute('SELECT deal_id, amount, description, seller_id, buyer_id FROM deals')
-    rows = cursor.fetchall()
-    for row in rows:
-        deal_id, amount, description, seller_id, buyer_id = row
-        deals[deal_id] = {
-            'amount': amount,
-            'description': description,
-            'seller_id': seller_id,
-            'buyer_id': buyer_id
-        }
-
-    conn.close()
+    deals.load((row[0], storage.deal_from_row(row)) for row in conn.execute(storage.SQL_LOAD_DEALS))
 
 
+# Изменения пользователей и сделок попадают в журнал отложенной записи и
+# сбрасываются в базу пачками (см. journal.py)
 def save_user_data(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    user = user_data.get(user_id, {})
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, wallet, balance, successful_deals, lang)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, user.get('wallet', ''), user.get('balance', 0.0), user.get('successful_deals', 0), user.get('lang', 'ru')))
-    conn.commit()
-    conn.close()
+    journal.mark_user(user_id, user_data.get(user_id) or User())
 
 
 def save_deal(deal_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    deal = deals.get(deal_id, {})
-    cursor.execute('''
-        INSERT OR REPLACE INTO deals (deal_id, amount, description, seller_id, buyer_id)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (deal_id, deal.get('amount', 0.0), deal.get('description', ''), deal.get('seller_id', None), deal.get('buyer_id', None)))
-    conn.commit()
-    conn.close()
+    journal.mark_deal(deal_id, deals.get(deal_id) or Deal())
 
 
 def delete_deal(deal_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM deals WHERE deal_id = ?', (deal_id,))
-    conn.commit()
-    conn.close()
-
-
-def add_admin(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (user_id,))
-    conn.commit()
-    conn.close()
-    ADMIN_IDS.add(user_id)
-
-
-def remove_admin(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-    ADMIN_IDS.discard(user_id)
-
-
-def get_admins():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM admins')
-    admins = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return admins
+    journal.mark_deal_deleted(deal_id)
 
 
 # ------------------------------
@@ -185,18 +158,243 @@ def get_admins():
 # Используется в проверках при оплате сделок.
 
 def get_user_balance(user_id):
-    if user_id in ADMIN_IDS:
+    if config.is_admin(user_id):
         return float('inf')
-    return user_data.get(user_id, {}).get('balance', 0.0)
+    user = user_data.get(user_id)
+    return user.balance if user else 0.0
+
+
+# Язык пользователя (по умолчанию - русский)
+def get_lang(user_id):
+    user = user_data.get(user_id)
+    return user.lang if user else 'ru'
 
 
 # Функция для проверки и создания записи пользователя, если её нет
 def ensure_user_exists(user_id):
     if user_id not in user_data:
-        user_data[user_id] = {'wallet': '', 'balance': 0.0, 'successful_deals': 0, 'lang': 'ru'}
+        user_data[user_id] = User()
         save_user_data(user_id)
 
 
+# ------------------------------
+#  Расчёт по сделке
+# ------------------------------
+# Списание у покупателя, зачисление продавцу, счётчик успешных сделок и перенос сделки в историю
+# выполняются под блокировками сделки и балансов обеих сторон и фиксируются в базе одной транзакцией.
+# Балансы проверяются и меняются в самой базе, в память записываются уже итоговые значения.
+# idempotency_key (id callback-запроса) не даёт провести один и тот же запрос дважды.
+# Возвращает 'settled', 'insufficient', 'not_found' или 'duplicate'.
+# Уведомления отправляются вызывающим кодом уже после фиксации.
+
+async def settle_payment(deal_id, buyer_id, idempotency_key):
+    deal = deals.get(deal_id)
+    if deal is None:
+        return 'not_found'
+    seller_id = deal.seller_id
+
+    # Блокируем сделку и балансы обеих сторон; наличие сделки проверяем повторно под блокировкой
+    async with locks.hold_many(('deal', deal_id), ('user', buyer_id), ('user', seller_id)):
+        deal = deals.get(deal_id)
+        if deal is None:
+            return 'not_found'
+        amount = deal.amount
+
+        ensure_user_exists(buyer_id)
+        ensure_user_exists(seller_id)
+
+        # Используем функцию get_user_balance(), которая возвращает бесконечность для админов
+        if get_user_balance(buyer_id) < amount:
+            return 'insufficient'
+
+        # Средства у админа не списываются
+        debit = 0.0 if config.is_admin(buyer_id) else amount
+        status, stats = await storage.run_async(
+            backend.get().settle_deal, idempotency_key, deal_id, snapshot(deal), buyer_id, debit
+        )
+        if status == 'insufficient':
+            return status
+
+        # Сделка уже оплачена и перенесена в историю: убираем её из активных в любом случае
+        del deals[deal_id]
+        delete_deal(deal_id)
+        for user_id, (balance, successful_deals) in stats.items():
+            user_data[user_id].balance = balance
+            user_data[user_id].successful_deals = successful_deals
+        return status
+
+
+# ------------------------------
+#  Синхронизация нескольких процессов
+# ------------------------------
+# Читает журнал изменений других процессов и сбрасывает изменённые записи из кэша,
+# настройки перечитываются при смене их версии.
+
+_last_change_id = 0
+
+
+def apply_changes(changes):
+    for kind, key in changes:
+        if kind == 'user':
+            user_data.invalidate(int(key))
+        elif kind == 'deal':
+            deals.invalidate(key)
+        elif kind == 'conversation':
+            conversation.invalidate(int(key))
+
+
+async def sync_state():
+    global _last_change_id
+    _last_change_id = await storage.run_async(backend.get().last_change_id)
+    last_purge = time.time()
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+        try:
+            _last_change_id, changes = await storage.run_async(backend.get().changes_since, _last_change_id)
+            apply_changes(changes)
+            await config.refresh()
+            if time.time() - last_purge > CHANGES_RETENTION:
+                await storage.run_async(backend.get().purge_changes, time.time() - CHANGES_RETENTION)
+                last_purge = time.time()
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации состояния: {e}")
+
+
+# ------------------------------
+#  Отмена просроченных сделок
+# ------------------------------
+# Сделки отменяются короткими транзакциями по DEAL_SWEEP_BATCH штук, чтобы не держать
+# блокировку базы; уведомление продавцу ставится в очередь отправки.
+# На время отмены берутся блокировки сделок: покупатель не может присоединиться (start),
+# а его присоединение, которое ещё в журнале, успевает попасть в базу до проверки статуса.
+
+async def notify_deal_expired(bot, deal_id, deal):
+    await user_data.prefetch(deal.seller_id)
+    lang = get_lang(deal.seller_id)
+    outbox.send_message(
+        bot,
+        deal.seller_id,
+        get_text(lang, "deal_expired_message", deal_id=deal_id, days=f"{DEAL_TTL_DAYS:g}", amount=deal.amount, valute=config.valute(), description=deal.description),
+        priority=outbox.Priority.BROADCAST
+    )
+
+
+async def sweep_expired_deals(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await journal.flush()  # Новые сделки могут быть ещё не записаны в базу
+        older_than = int(time.time() - DEAL_TTL_DAYS * 24 * 60 * 60)
+        reclaimed = 0
+        for _ in range(DEAL_SWEEP_MAX_BATCHES):
+            deal_ids = await storage.run_async(backend.get().expired_deal_ids, older_than, DEAL_SWEEP_BATCH)
+            if not deal_ids:
+                break
+            async with locks.hold_many(*(('deal', deal_id) for deal_id in deal_ids)):
+                await journal.flush()  # Покупатель мог присоединиться к сделке, а изменение ещё в журнале
+                expired = await storage.run_async(backend.get().expire_deals, deal_ids, older_than)
+                for deal_id, _ in expired:
+                    deals.invalidate(deal_id)
+                    delete_deal(deal_id)  # Незаписанное изменение сделки не должно вернуть её в базу
+            reclaimed += len(expired)
+            await fanout.fan_out(lambda item: notify_deal_expired(context.bot, *item), expired)
+            if len(deal_ids) < DEAL_SWEEP_BATCH:
+                break
+        if reclaimed:
+            logger.info(f"Отменено просроченных сделок: {reclaimed}")
+    except Exception as e:
+        logger.error(f"Ошибка при отмене просроченных сделок: {e}")
+
+
+# Снимок балансов; расхождения users.balance с журналом переводов пишутся в лог
+async def take_balance_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        result = await storage.run_async(backend.get().take_balance_snapshot, BALANCE_SNAPSHOTS_KEPT)
+        if result is None:
+            return
+        snapshot_id, ledger_id, mismatches = result
+        logger.info(f"Снимок балансов {snapshot_id} записан по журналу до записи {ledger_id}")
+        for user_id, balance, expected in mismatches:
+            logger.error(f"Баланс пользователя {user_id} ({balance}) не совпадает с журналом переводов ({expected})")
+    except Exception as e:
+        logger.error(f"Ошибка при записи снимка балансов: {e}")
+
+
+def first_snapshot_delay():
+    # Интервал отсчитывается от последнего снимка, а не от запуска: иначе бот, который
+    # перезапускают чаще раза в BALANCE_SNAPSHOT_INTERVAL, не записал бы ни одного снимка
+    last = backend.get().last_snapshot_time()
+    if last is None:
+        return BALANCE_SNAPSHOT_MIN_DELAY
+    return max(BALANCE_SNAPSHOT_MIN_DELAY, last + BALANCE_SNAPSHOT_INTERVAL - time.time())
+
+
+# Запоминаем username отправителя каждого обновления, чтобы реже вызывать get_chat
+# и заранее подгружаем из базы его запись и состояние диалога
+@logs.with_user
+async def track_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    usernames.remember(update.effective_user)
+    if update.effective_user:
+        await user_data.prefetch(update.effective_user.id)
+        await conversation.prefetch(update.effective_user.id)
+
+
+# Начало описания для списка сделок
+def preview(description):
+    if len(description) <= DEAL_DESCRIPTION_PREVIEW:
+        return description
+    return description[:DEAL_DESCRIPTION_PREVIEW - 1] + '…'
+
+
+# Постраничный просмотр активных сделок для админа.
+# Страница выбирается по курсору (created_at, rowid), поэтому её стоимость не зависит от числа сделок.
+async def show_deals_page(update: Update, context: ContextTypes.DEFAULT_TYPE, direction=None, cursor=None):
+    query = update.callback_query
+    chat_id = query.message.chat_id
+
+    await journal.flush()  # Новые сделки могут быть ещё не записаны в базу
+    if direction == 'prev':
+        rows, has_prev = await storage.run_async(backend.get().get_deals_page, None, cursor, DEALS_PAGE_SIZE)
+        has_next = True
+    else:
+        rows, has_next = await storage.run_async(backend.get().get_deals_page, cursor, None, DEALS_PAGE_SIZE)
+        has_prev = cursor is not None
+
+    if not rows:
+        if direction is None:
+            outbox.send_message(context.bot, chat_id, "Нет активных сделок.")
+        else:
+            outbox.edit_message_text(query, "Нет активных сделок.")
+        return
+
+    # Запрашиваем username всех участников параллельно
+    names = await usernames.get_usernames(context.bot, [row[4] for row in rows] + [row[5] for row in rows])
+    deals_list = []
+    for _, deal_id, amount, description, seller_id, buyer_id, _, status in rows:
+        deals_list.append(
+            f"Сделка {deal_id}:\n"
+            f"Статус: {status}\n"
+            f"Сумма: {amount} {config.valute()}\n"
+            f"Описание: {preview(description)}\n"
+            f"Продавец: @{names.get(seller_id, 'Неизвестно')} (ID: {seller_id})\n"
+            f"Покупатель: @{names.get(buyer_id, 'Неизвестно')} (ID: {buyer_id})\n"
+        )
+
+    navigation = []
+    if has_prev:
+        first = rows[0]
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=f'admin_deals_prev_{first[6]}_{first[0]}'))
+    if has_next:
+        last = rows[-1]
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f'admin_deals_next_{last[6]}_{last[0]}'))
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+
+    text = "Активные сделки:\n\n" + "\n".join(deals_list)
+    if direction is None:
+        outbox.send_message(context.bot, chat_id, text, reply_markup=reply_markup)
+    else:
+        outbox.edit_message_text(query, text, reply_markup=reply_markup)
+
+
+@logs.with_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Получаем user_id в зависимости от типа обновления
@@ -204,6 +402,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = update.message.from_user.id
             chat_id = update.message.chat_id
             args = context.args  # Получаем аргументы команды /start
+            logs.bind(route='/start')
         elif update.callback_query:  # Если это callback-запрос
             user_id = update.callback_query.from_user.id
             chat_id = update.callback_query.message.chat_id
@@ -211,435 +410,572 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             return
 
-        lang = user_data.get(user_id, {}).get('lang', 'ru')  # Получаем язык пользователя
+        lang = get_lang(user_id)  # Получаем язык пользователя
+
+        if args:
+            await deals.prefetch(args[0])
 
         # Если передан deal_id и сделка существует
         if args and args[0] in deals:
             deal_id = args[0]
+            logs.bind(deal_id=deal_id)
             deal = deals[deal_id]
-            seller_id = deal['seller_id']
-            seller_username = (await context.bot.get_chat(seller_id)).username if seller_id else "Неизвестно"
-
-            # Добавляем покупателя в сделку
-            deals[deal_id]['buyer_id'] = user_id
-            save_deal(deal_id)  # Сохраняем сделку в базу данных
+            seller_id = deal.seller_id
+            seller = user_data.get(seller_id)
+            seller_username = await usernames.get_username(context.bot, seller_id) if seller_id else "Неизвестно"
+
+            # Добавляем покупателя в сделку. Пока ждали ответа Telegram, сделку могли оплатить или отменить,
+            # а запись в кэше - заменить (sync_state, вытеснение), поэтому перечитываем её под блокировкой
+            async with locks.hold(('deal', deal_id)):
+                deal = deals.get(deal_id)
+                if deal is None:
+                    return
+                deal.buyer_id = user_id
+                deal.status = DealStatus.JOINED.value
+                save_deal(deal_id)  # Сохраняем сделку в базу данных
 
             # Уведомление покупателю
-            await context.bot.send_message(
+            outbox.send_message(
+                context.bot,
                 chat_id,
                 get_text(lang, "deal_info_message", 
                          deal_id=deal_id, 
                          seller_username=seller_username, 
-                         successful_deals=user_data.get(seller_id, {}).get('successful_deals', 0), 
-                         description=deal['description'], 
-                         wallet=user_data.get(seller_id, {}).get('wallet', 'Не указан'), 
-                         amount=deal['amount'], 
-                         valute=VALUTE),
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(get_text(lang, "pay_from_balance_button"), callback_data=f'pay_from_balance_{deal_id}')],
-                    [InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]
-                ])
+                         successful_deals=seller.successful_deals if seller else 0, 
+                         description=deal.description, 
+                         wallet=seller.wallet if seller else 'Не указан', 
+                         amount=deal.amount, 
+                         valute=config.valute()),
+                reply_markup=keyboards.deal_keyboard(lang, deal_id)
             )
 
             # Уведомление продавцу
-            buyer_username = (await context.bot.get_chat(user_id)).username if user_id else "Неизвестно"
-            await context.bot.send_message(
+            buyer_username = await usernames.get_username(context.bot, user_id) if user_id else "Неизвестно"
+            outbox.send_message(
+                context.bot,
                 seller_id,
                 get_text(lang, "seller_notification_message", 
                          buyer_username=buyer_username, 
                          deal_id=deal_id, 
-                         successful_deals=user_data.get(seller_id, {}).get('successful_deals', 0))
+                         successful_deals=seller.successful_deals if seller else 0)
             )
 
             return  # Завершаем выполнение функции, чтобы не показывать главное меню 
 
-        if user_id in ADMIN_IDS:
+        reply_markup = keyboards.main_keyboard(lang, config.is_admin(user_id))
+        if config.is_admin(user_id):
             # Админ-панель
-            keyboard = [
-                [InlineKeyboardButton(get_text(lang, "admin_view_deals_button"), callback_data='admin_view_deals')],
-                [InlineKeyboardButton(get_text(lang, "admin_change_balance_button"), callback_data='admin_change_balance')],
-                [InlineKeyboardButton(get_text(lang, "admin_change_successful_deals_button"), callback_data='admin_change_successful_deals')],
-                [InlineKeyboardButton(get_text(lang, "admin_change_valute_button"), callback_data='admin_change_valute')],
-                [InlineKeyboardButton(get_text(lang, "admin_manage_admins_button"), callback_data='admin_manage_admins')],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, get_text(lang, "admin_panel_message"), reply_markup=reply_markup)
+            outbox.send_message(context.bot, chat_id, get_text(lang, "admin_panel_message"), reply_markup=reply_markup)
         else:
             # Обычное меню для пользователей
-            keyboard = [
-                [InlineKeyboardButton(get_text(lang, "add_wallet_button"), callback_data='wallet')],
-                [InlineKeyboardButton(get_text(lang, "create_deal_button"), callback_data='create_deal')],
-                [InlineKeyboardButton(get_text(lang, "referral_button"), callback_data='referral')],
-                [InlineKeyboardButton(get_text(lang, "change_lang_button"), callback_data='change_lang')],
-                [InlineKeyboardButton(get_text(lang, "support_button"), url='https://t.me/sup0rtefl')],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_photo(
+            media.send_photo(
+                context.bot,
                 chat_id,
-                photo="https://postimg.cc/8sHq27HV",
+                START_PHOTO,
                 caption=get_text(lang, "start_message"),
                 reply_markup=reply_markup
             )
     except Exception as e:
         logger.error(f"Ошибка в функции start: {e}")
-        await context.bot.send_message(chat_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+        outbox.send_message(context.bot, chat_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 
+@logs.with_user
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
         await query.answer()
-        data = query.data
         user_id = query.from_user.id
         chat_id = query.message.chat_id
-        lang = user_data.get(user_id, {}).get('lang', 'ru')
-
-        # Обработка выбора языка
-        if data.startswith('lang_'):
-            new_lang = data.split('_')[-1]
-            ensure_user_exists(user_id)
-            user_data[user_id]['lang'] = new_lang
-            save_user_data(user_id)  # Сохраняем изменения в базе данных
-            await query.edit_message_text(get_text(new_lang, "lang_set_message"))
-
-            # После смены языка показываем меню
-            await start(update, context)  # Вызываем функцию start для отображения меню
-            return  # Завершаем выполнение, чтобы не обрабатывать другие условия
-
-        # Остальные условия обработки кнопок
-        elif data == 'wallet':
-            try:
-                wallet = user_data.get(user_id, {}).get('wallet', None)
-                if wallet:
-                    await context.bot.send_message(
-                        chat_id,
-                        get_text(lang, "wallet_message", wallet=wallet),
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id,
-                        get_text(lang, "wallet_message", wallet="Не указан"),
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-                    )
-                context.user_data['awaiting_wallet'] = True  # Устанавливаем флаг ожидания кошелька
-            except Exception as e:
-                logger.error(f"Ошибка в обработке кнопки 'wallet': {e}")
-                await query.edit_message_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
-
-        elif data == 'create_deal':
-            await context.bot.send_photo(
-                chat_id,
-                photo="https://postimg.cc/8sHq27HV",
-                caption=get_text(lang, "create_deal_message", valute=VALUTE),
-                parse_mode="MarkdownV2",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-            )
-            context.user_data['awaiting_amount'] = True  # Устанавливаем флаг ожидания суммы
+        callback = router.Callback(query, user_id, chat_id, get_lang(user_id))
+        await router.dispatch(update, context, callback, config.is_admin(user_id))
 
-        elif data == 'referral':
-            referral_link = f"https://t.me/GiftELFBARbot?start=ref_{user_id}"
-            await context.bot.send_message(
-                chat_id,
-                get_text(lang, "referral_message", referral_link=referral_link, valute=VALUTE),
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-            )
+    except Exception as e:
+        logger.error(f"Ошибка в функции button: {e}")
+        outbox.send_message(context.bot, chat_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-        elif data == 'change_lang':
-            await context.bot.send_message(
-                chat_id,
-                get_text(lang, "change_lang_message"),
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(get_text(lang, "english_lang_button"), callback_data='lang_en')],
-                    [InlineKeyboardButton(get_text(lang, "russian_lang_button"), callback_data='lang_ru')]
-                ])
-            )
 
-        elif data == 'menu':
-            # Возврат в главное меню
-            await start(update, context)
+# ------------------------------
+#  Обработчики кнопок
+# ------------------------------
+# Регистрируются в router по точному значению callback_data или по префиксу.
+
+# Обработка выбора языка
+@router.prefix('lang_')
+async def on_lang(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    new_lang = callback.arg
+    ensure_user_exists(callback.user_id)
+    user_data[callback.user_id].lang = new_lang
+    save_user_data(callback.user_id)  # Сохраняем изменения в базе данных
+    outbox.edit_message_text(callback.query, get_text(new_lang, "lang_set_message"))
 
-        # Админ-панель
-        elif data == 'admin_view_deals':
-            if user_id in ADMIN_IDS:
-                if not deals:
-                    await context.bot.send_message(chat_id, "Нет активных сделок.")
-                else:
-                    deals_list = []
-                    for deal_id, deal in deals.items():
-                        seller_username = (await context.bot.get_chat(deal['seller_id'])).username if deal['seller_id'] else "Неизвестно"
-                        buyer_username = (await context.bot.get_chat(deal['buyer_id'])).username if deal['buyer_id'] else "Неизвестно"
-                        deals_list.append(
-                            f"Сделка {deal_id}:\n"
-                            f"Сумма: {deal['amount']} {VALUTE}\n"
-                            f"Описание: {deal['description']}\n"
-                            f"Продавец: @{seller_username} (ID: {deal['seller_id']})\n"
-                            f"Покупатель: @{buyer_username} (ID: {deal['buyer_id']})\n"
-                        )
-                    await context.bot.send_message(chat_id, "Активные сделки:\n\n" + "\n".join(deals_list))
-
-        elif data == 'admin_change_balance':
-            if user_id in ADMIN_IDS:
-                await query.edit_message_text(get_text(lang, "admin_change_balance_message"))
-                admin_commands[user_id] = 'change_balance'
-
-        elif data == 'admin_change_successful_deals':
-            if user_id in ADMIN_IDS:
-                await query.edit_message_text(get_text(lang, "admin_change_successful_deals_message"))
-                admin_commands[user_id] = 'change_successful_deals'
-
-        elif data == 'admin_change_valute':
-            if user_id in ADMIN_IDS:
-                await query.edit_message_text(get_text(lang, "admin_change_valute_message"))
-                admin_commands[user_id] = 'change_valute'
-
-        elif data == 'admin_manage_admins':
-            if user_id in ADMIN_IDS:
-                current_admins = get_admins()
-                admins_list = []
-                for admin_id in current_admins:
-                    try:
-                        username = (await context.bot.get_chat(admin_id)).username
-                        admins_list.append(f"@{username} (ID: {admin_id})")
-                    except:
-                        admins_list.append(f"Неизвестный пользователь (ID: {admin_id})")
-
-                keyboard = [
-                    [InlineKeyboardButton(get_text(lang, "admin_add_admin_button"), callback_data='admin_add_admin')],
-                    [InlineKeyboardButton(get_text(lang, "admin_remove_admin_button"), callback_data='admin_remove_admin')],
-                    [InlineKeyboardButton(get_text(lang, "back_button"), callback_data='menu')]
-                ]
-
-                await query.edit_message_text(
-                    get_text(lang, "admin_manage_admins_message", admins_list="\n".join(admins_list)),
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-
-        elif data == 'admin_add_admin':
-            if user_id in ADMIN_IDS:
-                await query.edit_message_text(get_text(lang, "admin_add_admin_message"))
-                admin_commands[user_id] = 'add_admin'
-
-        elif data == 'admin_remove_admin':
-            if user_id in ADMIN_IDS:
-                current_admins = get_admins()
-                keyboard = []
-                for admin_id in current_admins:
-                    if admin_id != user_id:  # Нельзя удалить себя
-                        try:
-                            username = (await context.bot.get_chat(admin_id)).username
-                            keyboard.append([InlineKeyboardButton(f"@{username} (ID: {admin_id})", callback_data=f'remove_admin_{admin_id}')])
-                        except:
-                            keyboard.append([InlineKeyboardButton(f"Неизвестный пользователь (ID: {admin_id})", callback_data=f'remove_admin_{admin_id}')])
-                keyboard.append([InlineKeyboardButton(get_text(lang, "back_button"), callback_data='admin_manage_admins')])
-
-                await query.edit_message_text(
-                    get_text(lang, "admin_remove_admin_message"),
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-
-        elif data.startswith('remove_admin_'):
-            if user_id in ADMIN_IDS:
-                target_admin_id = int(data.split('_')[-1])
-                if target_admin_id != user_id:  # Нельзя удалить себя
-                    remove_admin(target_admin_id)
-                    await query.edit_message_text(
-                        get_text(lang, "admin_removed_message", admin_id=target_admin_id),
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "back_button"), callback_data='admin_manage_admins')]])
-                    )
-
-        # Обработка оплаты с баланса (с учетом бесконечного баланса админов)
-        elif data.startswith('pay_from_balance_'):
-            deal_id = data.split('_')[-1]  # Извлекаем deal_id из callback_data
-            deal = deals.get(deal_id)
-            if deal:
-                buyer_id = user_id
-                seller_id = deal['seller_id']
-                amount = deal['amount']
-
-                # Проверяем и создаем записи, если их нет
-                ensure_user_exists(buyer_id)
-                ensure_user_exists(seller_id)
-
-                # Используем функцию get_user_balance(), которая возвращает бесконечность для админов
-                if get_user_balance(buyer_id) >= amount:
-                    # Списание средств у покупателя (если он не админ)
-                    if buyer_id not in ADMIN_IDS:
-                        user_data[buyer_id]['balance'] -= amount
-                        save_user_data(buyer_id)  # Сохраняем изменения в базе данных
-
-                    # Зачисление средств продавцу
-                    user_data[seller_id]['balance'] += amount
-                    save_user_data(seller_id)  # Сохраняем изменения в базе данных
-
-                    # Уведомление покупателю
-                    await context.bot.send_message(
-                        chat_id,
-                        get_text(lang, "payment_confirmed_message", deal_id=deal_id, amount=amount, valute=VALUTE, description=deal['description']),
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-                    )
-
-                    # Возврат покупателя в главное меню
-                    await start(update, context)
-
-                    # Уведомление продавцу
-                    buyer_username = (await context.bot.get_chat(buyer_id)).username if buyer_id else "Неизвестно"
-                    await context.bot.send_message(
-                        seller_id,
-                        get_text(lang, "payment_confirmed_seller_message", 
-                                 deal_id=deal_id, 
-                                 description=deal['description'], 
-                                 buyer_username=buyer_username)
-                    )
-
-                    # Увеличение количества успешных сделок у продавца
-                    user_data[seller_id]['successful_deals'] += 1
-                    save_user_data(seller_id)  # Сохраняем изменения в базе данных
-
-                    # Удаление сделки из списка активных
-                    del deals[deal_id]
-                    delete_deal(deal_id)  # Удаляем сделку из базы данных
-                else:
-                    await context.bot.send_message(
-                        chat_id,
-                        get_text(lang, "insufficient_balance_message"),
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-                    )
+    # После смены языка показываем меню
+    await start(update, context)  # Вызываем функцию start для отображения меню
 
+
+@router.exact('wallet')
+async def on_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    lang = callback.lang
+    try:
+        user = user_data.get(callback.user_id)
+        wallet = user.wallet if user else None
+        outbox.send_message(
+            context.bot,
+            callback.chat_id,
+            get_text(lang, "wallet_message", wallet=wallet or "Не указан"),
+            reply_markup=keyboards.menu_keyboard(lang)
+        )
+        conversation.set_state(callback.user_id, conversation.State.AWAITING_WALLET)  # Ждём новый кошелек
     except Exception as e:
-        logger.error(f"Ошибка в функции button: {e}")
-        await context.bot.send_message(chat_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+        logger.error(f"Ошибка в обработке кнопки 'wallet': {e}")
+        outbox.edit_message_text(callback.query, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+
+@router.exact('create_deal')
+async def on_create_deal(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    media.send_photo(
+        context.bot,
+        callback.chat_id,
+        START_PHOTO,
+        caption=get_text(callback.lang, "create_deal_message", valute=config.valute()),
+        parse_mode="MarkdownV2",
+        reply_markup=keyboards.menu_keyboard(callback.lang)
+    )
+    conversation.set_state(callback.user_id, conversation.State.AWAITING_AMOUNT)  # Ждём сумму сделки
+
+
+@router.exact('referral')
+async def on_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    referral_link = f"https://t.me/GiftELFBARbot?start=ref_{callback.user_id}"
+    outbox.send_message(
+        context.bot,
+        callback.chat_id,
+        get_text(callback.lang, "referral_message", referral_link=referral_link, valute=config.valute()),
+        reply_markup=keyboards.menu_keyboard(callback.lang)
+    )
+
+
+@router.exact('change_lang')
+async def on_change_lang(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    outbox.send_message(
+        context.bot,
+        callback.chat_id,
+        get_text(callback.lang, "change_lang_message"),
+        reply_markup=keyboards.change_lang_keyboard(callback.lang)
+    )
+
+
+@router.exact('menu')
+async def on_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    # Возврат в главное меню
+    await start(update, context)
 
 
+# Админ-панель
+@router.exact('admin_view_deals', admin_only=True)
+async def on_admin_view_deals(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    await show_deals_page(update, context)
+
+
+@router.prefix('admin_deals_', admin_only=True)
+async def on_admin_deals_page(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    # Листание списка сделок: admin_deals_<next|prev>_<created_at>_<rowid>
+    direction, created_at, rowid = callback.arg.split('_')
+    await show_deals_page(update, context, direction, (int(created_at), int(rowid)))
+
+
+@router.exact('admin_change_balance', admin_only=True)
+async def on_admin_change_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    outbox.edit_message_text(callback.query, get_text(callback.lang, "admin_change_balance_message"))
+    conversation.set_state(callback.user_id, conversation.State.ADMIN_CHANGE_BALANCE)
+
+
+@router.exact('admin_change_successful_deals', admin_only=True)
+async def on_admin_change_successful_deals(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    outbox.edit_message_text(callback.query, get_text(callback.lang, "admin_change_successful_deals_message"))
+    conversation.set_state(callback.user_id, conversation.State.ADMIN_CHANGE_SUCCESSFUL_DEALS)
+
+
+@router.exact('admin_change_valute', admin_only=True)
+async def on_admin_change_valute(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    outbox.edit_message_text(callback.query, get_text(callback.lang, "admin_change_valute_message"))
+    conversation.set_state(callback.user_id, conversation.State.ADMIN_CHANGE_VALUTE)
+
+
+@router.exact('admin_manage_admins', admin_only=True)
+async def on_admin_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    current_admins = sorted(config.admins())
+    names = await usernames.get_usernames(context.bot, current_admins)
+    admins_list = []
+    for admin_id in current_admins:
+        if admin_id in names:
+            admins_list.append(f"@{names[admin_id]} (ID: {admin_id})")
+        else:
+            admins_list.append(f"Неизвестный пользователь (ID: {admin_id})")
+
+    outbox.edit_message_text(
+        callback.query,
+        get_text(callback.lang, "admin_manage_admins_message", admins_list="\n".join(admins_list)),
+        reply_markup=keyboards.manage_admins_keyboard(callback.lang)
+    )
+
+
+@router.exact('admin_add_admin', admin_only=True)
+async def on_admin_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    outbox.edit_message_text(callback.query, get_text(callback.lang, "admin_add_admin_message"))
+    conversation.set_state(callback.user_id, conversation.State.ADMIN_ADD_ADMIN)
+
+
+@router.exact('admin_remove_admin', admin_only=True)
+async def on_admin_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    current_admins = [admin_id for admin_id in sorted(config.admins()) if admin_id != callback.user_id]  # Нельзя удалить себя
+    names = await usernames.get_usernames(context.bot, current_admins)
+    keyboard = []
+    for admin_id in current_admins:
+        if admin_id in names:
+            keyboard.append([InlineKeyboardButton(f"@{names[admin_id]} (ID: {admin_id})", callback_data=f'remove_admin_{admin_id}')])
+        else:
+            keyboard.append([InlineKeyboardButton(f"Неизвестный пользователь (ID: {admin_id})", callback_data=f'remove_admin_{admin_id}')])
+    keyboard.append([keyboards.back_to_manage_admins_button(callback.lang)])
+
+    outbox.edit_message_text(
+        callback.query,
+        get_text(callback.lang, "admin_remove_admin_message"),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+@router.prefix('remove_admin_', admin_only=True)
+async def on_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    target_admin_id = int(callback.arg)
+    if target_admin_id != callback.user_id:  # Нельзя удалить себя
+        await config.remove_admin(target_admin_id)
+        outbox.edit_message_text(
+            callback.query,
+            get_text(callback.lang, "admin_removed_message", admin_id=target_admin_id),
+            reply_markup=keyboards.back_to_manage_admins_keyboard(callback.lang)
+        )
+
+
+# Обработка оплаты с баланса (с учетом бесконечного баланса админов)
+@router.prefix('pay_from_balance_')
+async def on_pay_from_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    lang = callback.lang
+    deal_id = callback.arg  # deal_id из callback_data
+    logs.bind(deal_id=deal_id)
+    await deals.prefetch(deal_id)
+    deal = deals.get(deal_id)
+    if deal:
+        buyer_id = callback.user_id
+        seller_id = deal.seller_id
+        await user_data.prefetch(seller_id)
+        amount = deal.amount
+        description = deal.description
+
+        status = await settle_payment(deal_id, buyer_id, callback.query.id)
+        if status == 'settled':
+            # Уведомление покупателю
+            outbox.send_message(
+                context.bot,
+                callback.chat_id,
+                get_text(lang, "payment_confirmed_message", deal_id=deal_id, amount=amount, valute=config.valute(), description=description),
+                priority=outbox.Priority.PAYMENT,
+                reply_markup=keyboards.menu_keyboard(lang)
+            )
+
+            # Возврат покупателя в главное меню
+            await start(update, context)
+
+            # Уведомление продавцу
+            buyer_username = await usernames.get_username(context.bot, buyer_id) if buyer_id else "Неизвестно"
+            outbox.send_message(
+                context.bot,
+                seller_id,
+                get_text(lang, "payment_confirmed_seller_message", 
+                         deal_id=deal_id, 
+                         description=description, 
+                         buyer_username=buyer_username),
+                priority=outbox.Priority.PAYMENT
+            )
+        elif status == 'insufficient':
+            outbox.send_message(
+                context.bot,
+                callback.chat_id,
+                get_text(lang, "insufficient_balance_message"),
+                reply_markup=keyboards.menu_keyboard(lang)
+            )
+
+
+@logs.with_user
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        global VALUTE  
         user_id = update.message.from_user.id
         text = update.message.text
-        lang = user_data.get(user_id, {}).get('lang', 'ru')
-
-        if user_id in ADMIN_IDS and admin_commands.get(user_id) == 'change_balance':
-            try:
-                target_user_id, new_balance = map(str.strip, text.split())
-                target_user_id = int(target_user_id)
-                new_balance = float(new_balance)
-                ensure_user_exists(target_user_id)
-                user_data[target_user_id]['balance'] = new_balance
-                save_user_data(target_user_id)  # Сохраняем изменения в базе данных
-                await update.message.reply_text(f"Баланс пользователя {target_user_id} изменен на {new_balance} {VALUTE}.")
-            except ValueError:
-                await update.message.reply_text("Неверный формат. Введите ID пользователя и баланс через пробел.")
-            admin_commands[user_id] = None
-
-        elif user_id in ADMIN_IDS and admin_commands.get(user_id) == 'change_successful_deals':
-            try:
-                target_user_id, new_successful_deals = map(str.strip, text.split())
-                target_user_id = int(target_user_id)
-                new_successful_deals = int(new_successful_deals)
-                ensure_user_exists(target_user_id)
-                user_data[target_user_id]['successful_deals'] = new_successful_deals
-                save_user_data(target_user_id)  # Сохраняем изменения в базе данных
-                await update.message.reply_text(f"Количество успешных сделок пользователя {target_user_id} изменено на {new_successful_deals}.")
-            except ValueError:
-                await update.message.reply_text("Неверный формат. Введите ID пользователя и количество успешных сделок через пробел.")
-            admin_commands[user_id] = None
-
-        elif user_id in ADMIN_IDS and admin_commands.get(user_id) == 'change_valute':
-            VALUTE = text.strip().upper()  
-            await update.message.reply_text(f"Валюта изменена на {VALUTE}.")
-            admin_commands[user_id] = None
-
-        elif user_id in ADMIN_IDS and admin_commands.get(user_id) == 'add_admin':
-            try:
-                new_admin_id = int(text.strip())
-                add_admin(new_admin_id)
-                try:
-                    username = (await context.bot.get_chat(new_admin_id)).username
-                    await update.message.reply_text(f"Пользователь @{username} (ID: {new_admin_id}) добавлен в администраторы.")
-                except:
-                    await update.message.reply_text(f"Пользователь (ID: {new_admin_id}) добавлен в администраторы.")
-                admin_commands[user_id] = None
-            except ValueError:
-                await update.message.reply_text("Неверный формат. Введите ID пользователя.")
-            except Exception as e:
-                await update.message.reply_text(f"Ошибка: {e}")
-
-        elif context.user_data.get('awaiting_amount', False):
-            try:
-                context.user_data['amount'] = float(text)
-                context.user_data['awaiting_amount'] = False
-                context.user_data['awaiting_description'] = True
-                await update.message.reply_text(
-                    get_text(lang, "awaiting_description_message"),
-                    parse_mode="MarkdownV2",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-                )
-            except ValueError:
-                await update.message.reply_text("Неверный формат. Введите число.")
-
-        elif context.user_data.get('awaiting_description', False):
-            deal_id = str(uuid.uuid4())
-            deals[deal_id] = {
-                'amount': context.user_data['amount'],
-                'description': text,
-                'seller_id': user_id,
-                'buyer_id': None
-            }
-            save_deal(deal_id)  # Сохраняем сделку в базу данных
-            context.user_data.clear()
-
-            await update.message.reply_text(
-                get_text(lang, "deal_created_message", amount=deals[deal_id]['amount'], valute=VALUTE, description=deals[deal_id]['description'], deal_link=f"https://t.me/GiftELFBARbot?start={deal_id}"),
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-            )
-            # Уведомление всем администраторам
-            seller_username = (await context.bot.get_chat(user_id)).username if user_id else "Неизвестно"
-            for admin_id in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(
-                        admin_id,
-                        f"Новая сделка создана:\n"
-                        f"ID: {deal_id}\n"
-                        f"Сумма: {deals[deal_id]['amount']} {VALUTE}\n"
-                        f"Описание: {deals[deal_id]['description']}\n"
-                        f"Продавец: @{seller_username} (ID: {user_id})"
-                    )
-                except:
-                    continue
-
-        elif context.user_data.get('awaiting_wallet', False):
-            try:
-                ensure_user_exists(user_id)  # Убедимся, что запись пользователя существует
-                user_data[user_id]['wallet'] = text  # Обновляем кошелек
-                save_user_data(user_id)  # Сохраняем изменения в базе данных
-                context.user_data.pop('awaiting_wallet', None)  # Очищаем флаг ожидания
-                await update.message.reply_text(
-                    get_text(lang, "wallet_updated_message", wallet=text),
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при обновлении кошелька: {e}")
-                await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        lang = get_lang(user_id)
+
+        # Обработчик выбирается по состоянию диалога пользователя
+        current = conversation.get(user_id)
+        if current is None:
+            return
+        state = conversation.State(current.state)
+        handler, admin_only = STATE_HANDLERS[state]
+        if admin_only and not config.is_admin(user_id):
+            return
+        with metrics.STATES.time(state.name), logs.context(route=state.name):
+            await handler(update, context, user_id, text, lang, current)
 
     except Exception as e:
         logger.error(f"Ошибка в функции handle_message: {e}")
-        await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        outbox.send_message(context.bot, update.message.chat_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 
-# Запуск бота
-def main() -> None:
-    init_db()  # Инициализация базы данных
-    load_data()  # Загрузка данных из базы данных
+# ------------------------------
+#  Обработчики состояний диалога
+# ------------------------------
+
+async def on_change_balance_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    try:
+        target_user_id, new_balance = map(str.strip, text.split())
+        target_user_id = int(target_user_id)
+        new_balance = float(new_balance)
+        # Отрицательные, слишком большие, inf и nan: в базе такие значения не поместятся
+        if not 0 < target_user_id <= MAX_USER_ID or not 0 <= new_balance <= MAX_BALANCE:
+            raise ValueError(text)
+        async with locks.hold(('user', target_user_id)):  # Не пересекаемся с расчётом по сделке
+            ensure_user_exists(target_user_id)
+            # Баланс сразу записываем в базу, а не через журнал; изменение попадает в журнал переводов
+            balance, _ = await storage.run_async(
+                backend.get().set_user_stats, target_user_id, new_balance, None, f"admin:{user_id}"
+            )
+            user_data[target_user_id].balance = balance
+        outbox.send_message(context.bot, update.message.chat_id, f"Баланс пользователя {target_user_id} изменен на {new_balance} {config.valute()}.")
+    except ValueError:
+        outbox.send_message(context.bot, update.message.chat_id, "Неверный формат. Введите ID пользователя и баланс через пробел.")
+    finally:
+        conversation.clear(user_id)  # Даже после неожиданной ошибки админ не остаётся в этом состоянии
+
+
+async def on_change_successful_deals_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    try:
+        target_user_id, new_successful_deals = map(str.strip, text.split())
+        target_user_id = int(target_user_id)
+        new_successful_deals = int(new_successful_deals)
+        if not 0 < target_user_id <= MAX_USER_ID or not 0 <= new_successful_deals <= MAX_SUCCESSFUL_DEALS:
+            raise ValueError(text)
+        async with locks.hold(('user', target_user_id)):  # Не пересекаемся с расчётом по сделке
+            ensure_user_exists(target_user_id)
+            _, successful_deals = await storage.run_async(
+                backend.get().set_user_stats, target_user_id, None, new_successful_deals
+            )
+            user_data[target_user_id].successful_deals = successful_deals
+        outbox.send_message(context.bot, update.message.chat_id, f"Количество успешных сделок пользователя {target_user_id} изменено на {new_successful_deals}.")
+    except ValueError:
+        outbox.send_message(context.bot, update.message.chat_id, "Неверный формат. Введите ID пользователя и количество успешных сделок через пробел.")
+    finally:
+        conversation.clear(user_id)
+
+
+async def on_change_valute_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    await config.set_value('valute', text.strip().upper())  # Другие процессы увидят новую версию настроек
+    outbox.send_message(context.bot, update.message.chat_id, f"Валюта изменена на {config.valute()}.")
+    conversation.clear(user_id)
+
+
+async def on_add_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    try:
+        new_admin_id = int(text.strip())
+        await config.add_admin(new_admin_id)
+        try:
+            username = await usernames.get_username(context.bot, new_admin_id)
+            outbox.send_message(context.bot, update.message.chat_id, f"Пользователь @{username} (ID: {new_admin_id}) добавлен в администраторы.")
+        except:
+            outbox.send_message(context.bot, update.message.chat_id, f"Пользователь (ID: {new_admin_id}) добавлен в администраторы.")
+        conversation.clear(user_id)
+    except ValueError:
+        outbox.send_message(context.bot, update.message.chat_id, "Неверный формат. Введите ID пользователя.")
+    except Exception as e:
+        outbox.send_message(context.bot, update.message.chat_id, f"Ошибка: {e}")
+
+
+async def on_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    try:
+        amount = float(text)
+        if not 0 < amount <= MAX_DEAL_AMOUNT:  # Ноль, отрицательные, слишком большие суммы и nan
+            raise ValueError(text)
+    except ValueError:
+        outbox.send_message(context.bot, update.message.chat_id, "Неверный формат. Введите число.")
+        return
+    conversation.set_state(user_id, conversation.State.AWAITING_DESCRIPTION, amount=amount)
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        get_text(lang, "awaiting_description_message"),
+        parse_mode="MarkdownV2",
+        reply_markup=keyboards.menu_keyboard(lang)
+    )
+
+
+async def on_description_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    deal_id = str(uuid.uuid4())
+    logs.bind(deal_id=deal_id)
+    deals[deal_id] = deal = Deal(
+        amount=current.amount,
+        description=text,
+        seller_id=user_id,
+        buyer_id=None,
+        created_at=int(time.time())
+    )
+    save_deal(deal_id)  # Сохраняем сделку в базу данных
+    conversation.clear(user_id)
+
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        get_text(lang, "deal_created_message", amount=deal.amount, valute=config.valute(), description=deal.description, deal_link=f"https://t.me/GiftELFBARbot?start={deal_id}"),
+        reply_markup=keyboards.menu_keyboard(lang)
+    )
+    # Уведомление всем администраторам
+    seller_username = await usernames.get_username(context.bot, user_id) if user_id else "Неизвестно"
+    admin_text = (
+        f"Новая сделка создана:\n"
+        f"ID: {deal_id}\n"
+        f"Сумма: {deal.amount} {config.valute()}\n"
+        f"Описание: {deal.description}\n"
+        f"Продавец: @{seller_username} (ID: {user_id})"
+    )
+    # Рассылка ставится в очередь с низким приоритетом и не задерживает ответ продавцу
+    for admin_id in config.admins():
+        outbox.send_message(context.bot, admin_id, admin_text, priority=outbox.Priority.BROADCAST)
+
+
+async def on_wallet_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text, lang, current):
+    try:
+        ensure_user_exists(user_id)  # Убедимся, что запись пользователя существует
+        user_data[user_id].wallet = text  # Обновляем кошелек
+        save_user_data(user_id)  # Сохраняем изменения в базе данных
+        conversation.clear(user_id)  # Сбрасываем ожидание кошелька
+        outbox.send_message(
+            context.bot,
+            update.message.chat_id,
+            get_text(lang, "wallet_updated_message", wallet=text),
+            reply_markup=keyboards.menu_keyboard(lang)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении кошелька: {e}")
+        outbox.send_message(context.bot, update.message.chat_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-    application = Application.builder().token(BOT_TOKEN).build()
+
+# Состояние диалога -> (обработчик, только для админов)
+STATE_HANDLERS = {
+    conversation.State.ADMIN_CHANGE_BALANCE: (on_change_balance_input, True),
+    conversation.State.ADMIN_CHANGE_SUCCESSFUL_DEALS: (on_change_successful_deals_input, True),
+    conversation.State.ADMIN_CHANGE_VALUTE: (on_change_valute_input, True),
+    conversation.State.ADMIN_ADD_ADMIN: (on_add_admin_input, True),
+    conversation.State.AWAITING_AMOUNT: (on_amount_input, False),
+    conversation.State.AWAITING_DESCRIPTION: (on_description_input, False),
+    conversation.State.AWAITING_WALLET: (on_wallet_input, False),
+}
+
+
+_sync_task = None
+
+
+# Запуск синхронизации с другими процессами бота
+async def on_startup(application: Application) -> None:
+    global _sync_task
+    if SHARED_STATE:
+        _sync_task = asyncio.create_task(sync_state())
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+    if MEDIA_UPLOAD_CHAT_ID is not None:
+        asyncio.create_task(media.preload(application.bot, [START_PHOTO], MEDIA_UPLOAD_CHAT_ID))
+
+
+# Отправка поставленных в очередь сообщений при остановке бота. Выполняется после остановки
+# обработчиков, но до закрытия HTTP-клиента бота: в on_shutdown отправить уже ничего нельзя.
+async def on_stop(application: Application) -> None:
+    await outbox.close()
+
+
+# Сброс несохранённых изменений при остановке бота
+async def on_shutdown(application: Application) -> None:
+    if _sync_task is not None:
+        _sync_task.cancel()
+    await metrics.stop_server()
+    await journal.close()
+
+
+# Подготовка базы данных, настроек и бэкенда перед запуском
+def prepare() -> None:
+    init_db()  # Инициализация базы данных
+    config.load()  # Валюта и список админов
+    conversation.purge_expired()  # Удаляем устаревшие состояния диалогов
+    if not LAZY_LOADING:
+        load_data()  # Загрузка данных из базы данных
+
+    state_backend = backend.SQLiteBackend(publish_changes=SHARED_STATE)
+    if METRICS_PORT:
+        # Обёртки для замеров ставятся только с включёнными метриками
+        metrics.enable()
+        state_backend = metrics.TimedBackend(state_backend)
+    backend.set_backend(state_backend)
+    media.load()  # Сохранённые file_id картинок
+
+
+# Приложение с фоновыми задачами и обработчиками. request подменяет HTTP-клиент Bot API
+# (скрипты в benchmarks/ запускают бота без сети)
+def build_application(token=BOT_TOKEN, request=None) -> Application:
+    builder = Application.builder().token(token).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    if request is not None:
+        builder = builder.request(request)
+    elif METRICS_PORT:
+        # Замер запросов к Bot API; long polling (getUpdates) идёт отдельным клиентом и не замеряется
+        builder = builder.request(metrics.TelegramRequest())
+    application = builder.build()
+
+    # Периодическая отмена просроченных сделок и снимки балансов
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(sweep_expired_deals, interval=DEAL_SWEEP_INTERVAL, first=60)
+        application.job_queue.run_repeating(take_balance_snapshot, interval=BALANCE_SNAPSHOT_INTERVAL, first=first_snapshot_delay())
+    else:
+        logger.warning('JobQueue недоступен (pip install "python-telegram-bot[job-queue]"): просроченные сделки не отменяются, снимки балансов не пишутся')
 
     # Регистрация обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(TypeHandler(Update, metrics.timed(metrics.HANDLERS, 'track_user')(track_user)), group=-1)
+    application.add_handler(CommandHandler("start", locks.per_user(metrics.timed(metrics.HANDLERS, 'start')(start))))
+    application.add_handler(CallbackQueryHandler(locks.per_user(metrics.timed(metrics.HANDLERS, 'button')(button))))
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND, locks.per_user(metrics.timed(metrics.HANDLERS, 'handle_message')(handle_message))
+    ))
+    return application
+
 
-    # Запуск бота
-    application.run_polling()
+# Запуск бота
+def main() -> None:
+    logs.setup(LOG_FILE, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, sample_level=LOG_SAMPLE_LEVEL, sample_rate=LOG_SAMPLE_RATE)
+    prepare()
+    application = build_application()
+
+    # Запуск бота. При остановке (SIGINT/SIGTERM) Application дообрабатывает уже
+    # полученные обновления, on_stop дожидается отправки сообщений из очереди,
+    # затем on_shutdown сбрасывает журнал в базу.
+    try:
+        if BOT_MODE == 'webhook':
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        else:
+            application.run_polling()
+    finally:
+        storage.close_all()  # Закрываем соединения с базой данных
+        logs.stop()  # Дописываем оставшиеся записи лога
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+import backend
+import storage
+
+# Настройки бота, которые меняются во время работы (валюта, список админов).
+# Хранятся в таблице config с версией у каждой записи. В памяти процесса держится снимок,
+# который перечитывается только при смене версии, поэтому проверки вроде is_admin()
+# в обработчиках не обращаются к базе.
+DEFAULTS = {
+    'valute': 'TON',  # По умолчанию валюта - TON
+}
+
+_version = None
+_values = dict(DEFAULTS)
+_admins = frozenset()
+
+
+def _apply(snapshot):
+    global _version, _values, _admins
+    version, values, admins = snapshot
+    if _version is not None and version < _version:
+        return  # Снимок, прочитанный раньше уже применённого
+    _values = {**DEFAULTS, **{key: value for key, value in values.items() if value is not None}}
+    _admins = frozenset(admins)
+    _version = version
+
+
+def get(key):
+    return _values.get(key)
+
+
+def valute():
+    return _values['valute']
+
+
+def is_admin(user_id):
+    return user_id in _admins
+
+
+def admins():
+    return _admins
+
+
+def load():
+    # Синхронная загрузка снимка при запуске
+    _apply(backend.get().load_config())
+
+
+async def refresh():
+    # Перечитывает настройки, если другой процесс их изменил; возвращает True при изменении
+    version = await storage.run_async(backend.get().config_version)
+    if version == _version:
+        return False
+    _apply(await storage.run_async(backend.get().load_config))
+    return True
+
+
+async def set_value(key, value):
+    _apply(await storage.run_async(backend.get().set_config, key, value))
+
+
+async def add_admin(user_id):
+    _apply(await storage.run_async(backend.get().add_admin, user_id))
+
+
+async def remove_admin(user_id):
+    _apply(await storage.run_async(backend.get().remove_admin, user_id))
@@ -0,0 +1,68 @@
+import time
+from enum import Enum
+
+import backend
+import journal
+from lazy import LazyTable
+from records import Conversation
+
+# Состояние диалога пользователя: чего бот ждёт от следующего текстового сообщения.
+# Хранится в таблице conversations, поэтому начатый сценарий продолжается после перезапуска.
+STATE_TTL = 24 * 60 * 60  # Через сколько секунд бездействия состояние сбрасывается
+CACHE_SIZE = 10000  # Максимум состояний в памяти
+
+
+class State(str, Enum):
+    AWAITING_WALLET = 'awaiting_wallet'
+    AWAITING_AMOUNT = 'awaiting_amount'
+    AWAITING_DESCRIPTION = 'awaiting_description'
+    ADMIN_CHANGE_BALANCE = 'change_balance'
+    ADMIN_CHANGE_SUCCESSFUL_DEALS = 'change_successful_deals'
+    ADMIN_CHANGE_VALUTE = 'change_valute'
+    ADMIN_ADD_ADMIN = 'add_admin'
+
+
+_conversations = LazyTable(lambda user_id: backend.get().load_conversation(user_id), journal.pending_conversation, CACHE_SIZE)
+
+
+def get(user_id):
+    # Текущее состояние диалога или None; устаревшие состояния сбрасываются
+    conversation = _conversations.get(user_id)
+    if conversation is None:
+        return None
+    if time.time() - conversation.updated_at > STATE_TTL:
+        clear(user_id)
+        return None
+    return conversation
+
+
+async def prefetch(user_id):
+    # Подгружает состояние (или его отсутствие) в потоке базы, чтобы get не читал диск в event loop
+    await _conversations.prefetch(user_id)
+
+
+def get_state(user_id):
+    conversation = get(user_id)
+    return State(conversation.state) if conversation else None
+
+
+def set_state(user_id, state, **payload):
+    conversation = Conversation(state.value, updated_at=time.time(), **payload)
+    _conversations[user_id] = conversation
+    journal.mark_conversation(user_id, conversation)
+
+
+def clear(user_id):
+    if user_id in _conversations:
+        del _conversations[user_id]
+        journal.mark_conversation(user_id, None)
+
+
+def invalidate(user_id):
+    # Состояние изменено другим процессом: перечитаем его из базы при следующем обращении
+    _conversations.invalidate(user_id)
+
+
+def purge_expired():
+    # Удаляет из базы состояния, устаревшие больше чем на STATE_TTL; возвращает их число
+    return backend.get().purge_conversations(time.time() - STATE_TTL)
@@ -0,0 +1,19 @@
+import asyncio
+
+# Параллельное выполнение запросов к Telegram с ограничением числа одновременных запросов.
+# Лимиты Bot API соблюдает outbox: отправка сообщений идёт через его очередь,
+# остальные запросы ждут outbox.throttle().
+MAX_CONCURRENCY = 10  # Одновременных запросов в одном fan_out
+
+
+async def fan_out(func, items, limit=MAX_CONCURRENCY):
+    # Вызывает func для каждого элемента параллельно, не более limit одновременно.
+    # Возвращает результаты в порядке items; исключения возвращаются как значения.
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
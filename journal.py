@@ -0,0 +1,179 @@
+import asyncio
+import logging
+
+import backend
+import storage
+from records import snapshot
+
+logger = logging.getLogger(__name__)
+
+# Отложенная запись (write-behind): изменённые записи копятся в памяти и сбрасываются
+# в базу одной транзакцией по таймеру или при достижении порога.
+MAX_STALENESS = 1.0  # Максимальная задержка записи в секундах
+MAX_BATCH = 500  # Сколько изменённых записей вызывает немедленный сброс
+
+_dirty_users = {}  # {user_id: ссылка на запись в user_data}
+_dirty_deals = {}  # {deal_id: ссылка на запись в deals или None, если сделка удалена}
+_dirty_usernames = {}  # {user_id: (username, updated_at)}
+_dirty_conversations = {}  # {user_id: Conversation или None, если диалог завершён}
+# Записи, которые сейчас сбрасываются в базу: до окончания записи в базе ещё старые значения
+_flushing_users = {}
+_flushing_deals = {}
+_flushing_conversations = {}
+MISSING = object()
+_flush_handle = None
+_flush_task = None
+_flush_requested = False  # Сброс понадобился, пока шёл предыдущий: запускаем его сразу после
+_flush_lock = asyncio.Lock()
+
+
+def mark_user(user_id, user):
+    _dirty_users[user_id] = user
+    _schedule_flush()
+
+
+def mark_deal(deal_id, deal):
+    _dirty_deals[deal_id] = deal
+    _schedule_flush()
+
+
+def mark_deal_deleted(deal_id):
+    _dirty_deals[deal_id] = None
+    _schedule_flush()
+
+
+def mark_username(user_id, username, updated_at):
+    _dirty_usernames[user_id] = (username, updated_at)
+    _schedule_flush()
+
+
+def mark_conversation(user_id, conversation):
+    _dirty_conversations[user_id] = conversation
+    _schedule_flush()
+
+
+def pending_user(user_id):
+    # Незаписанная запись пользователя или MISSING, если в журнале её нет
+    if user_id in _dirty_users:
+        return _dirty_users[user_id]
+    return _flushing_users.get(user_id, MISSING)
+
+
+def pending_deal(deal_id):
+    # Незаписанная сделка (None - удалена) или MISSING, если в журнале её нет
+    if deal_id in _dirty_deals:
+        return _dirty_deals[deal_id]
+    return _flushing_deals.get(deal_id, MISSING)
+
+
+def pending_conversation(user_id):
+    # Незаписанное состояние диалога (None - завершён) или MISSING, если в журнале его нет
+    if user_id in _dirty_conversations:
+        return _dirty_conversations[user_id]
+    return _flushing_conversations.get(user_id, MISSING)
+
+
+def pending():
+    return len(_dirty_users) + len(_dirty_deals) + len(_dirty_usernames) + len(_dirty_conversations)
+
+
+def _schedule_flush():
+    global _flush_handle
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # Вне event loop изменения будут записаны при следующем сбросе
+    if pending() >= MAX_BATCH:
+        _start_flush()
+    elif _flush_handle is None:
+        _flush_handle = loop.call_later(MAX_STALENESS, _on_timer)
+
+
+def _on_timer():
+    global _flush_handle
+    _flush_handle = None  # Таймер сработал: следующее изменение должно завести новый
+    _start_flush()
+
+
+def _start_flush():
+    global _flush_task, _flush_requested
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.get_running_loop().create_task(flush())
+        _flush_task.add_done_callback(_after_flush)
+    else:
+        _flush_requested = True
+
+
+def _after_flush(task):
+    # Изменения, пришедшие во время сброса, не должны ждать следующего изменения или MAX_BATCH
+    global _flush_requested
+    requested, _flush_requested = _flush_requested, False
+    if not pending():
+        return
+    if requested:
+        _start_flush()
+    else:
+        _schedule_flush()
+
+
+async def flush():
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    # Сбросы выполняются по очереди, чтобы более старый снимок не перезаписал более новый
+    async with _flush_lock:
+        await _flush()
+
+
+async def _flush():
+    global _flushing_users, _flushing_deals, _flushing_conversations
+    if not pending():
+        return
+
+    # Снимок делаем в потоке event loop, чтобы поток-писатель не видел записи в процессе изменения
+    dirty_users = dict(_dirty_users)
+    dirty_deals = dict(_dirty_deals)
+    dirty_usernames = dict(_dirty_usernames)
+    dirty_conversations = dict(_dirty_conversations)
+    _dirty_users.clear()
+    _dirty_deals.clear()
+    _dirty_usernames.clear()
+    _dirty_conversations.clear()
+    users = [(user_id, snapshot(user)) for user_id, user in dirty_users.items()]
+    saved_deals = [(deal_id, snapshot(deal)) for deal_id, deal in dirty_deals.items() if deal is not None]
+    deleted_deals = [deal_id for deal_id, deal in dirty_deals.items() if deal is None]
+    usernames = [(user_id, username, updated_at) for user_id, (username, updated_at) in dirty_usernames.items()]
+    conversations = [(user_id, snapshot(c)) for user_id, c in dirty_conversations.items() if c is not None]
+    ended_conversations = [user_id for user_id, c in dirty_conversations.items() if c is None]
+
+    _flushing_users = dirty_users
+    _flushing_deals = dirty_deals
+    _flushing_conversations = dirty_conversations
+    try:
+        await storage.run_async(
+            backend.get().write_batch, users, saved_deals, deleted_deals, usernames, conversations, ended_conversations
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе журнала: {e}")
+        # Возвращаем записи в журнал, если их не успели изменить заново
+        for user_id, user in dirty_users.items():
+            _dirty_users.setdefault(user_id, user)
+        for deal_id, deal in dirty_deals.items():
+            _dirty_deals.setdefault(deal_id, deal)
+        for user_id, entry in dirty_usernames.items():
+            _dirty_usernames.setdefault(user_id, entry)
+        for user_id, conversation in dirty_conversations.items():
+            _dirty_conversations.setdefault(user_id, conversation)
+        _schedule_flush()
+    finally:
+        _flushing_users = {}
+        _flushing_deals = {}
+        _flushing_conversations = {}
+
+
+async def close():
+    # Дожидаемся текущего сброса и записываем всё, что осталось
+    if _flush_task is not None and not _flush_task.done():
+        await _flush_task
+    await flush()
@@ -0,0 +1,74 @@
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from messages import get_text
+
+# Клавиатуры строятся один раз на язык (и роль) и переиспользуются:
+# объекты InlineKeyboardMarkup неизменяемы, поэтому их можно отправлять многократно.
+
+SUPPORT_URL = 'https://t.me/sup0rtefl'
+
+
+@lru_cache(maxsize=None)
+def menu_keyboard(lang):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "menu_button"), callback_data='menu')]])
+
+
+@lru_cache(maxsize=None)
+def main_keyboard(lang, is_admin):
+    if is_admin:
+        # Админ-панель
+        keyboard = [
+            [InlineKeyboardButton(get_text(lang, "admin_view_deals_button"), callback_data='admin_view_deals')],
+            [InlineKeyboardButton(get_text(lang, "admin_change_balance_button"), callback_data='admin_change_balance')],
+            [InlineKeyboardButton(get_text(lang, "admin_change_successful_deals_button"), callback_data='admin_change_successful_deals')],
+            [InlineKeyboardButton(get_text(lang, "admin_change_valute_button"), callback_data='admin_change_valute')],
+            [InlineKeyboardButton(get_text(lang, "admin_manage_admins_button"), callback_data='admin_manage_admins')],
+        ]
+    else:
+        # Обычное меню для пользователей
+        keyboard = [
+            [InlineKeyboardButton(get_text(lang, "add_wallet_button"), callback_data='wallet')],
+            [InlineKeyboardButton(get_text(lang, "create_deal_button"), callback_data='create_deal')],
+            [InlineKeyboardButton(get_text(lang, "referral_button"), callback_data='referral')],
+            [InlineKeyboardButton(get_text(lang, "change_lang_button"), callback_data='change_lang')],
+            [InlineKeyboardButton(get_text(lang, "support_button"), url=SUPPORT_URL)],
+        ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@lru_cache(maxsize=None)
+def change_lang_keyboard(lang):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "english_lang_button"), callback_data='lang_en')],
+        [InlineKeyboardButton(get_text(lang, "russian_lang_button"), callback_data='lang_ru')]
+    ])
+
+
+@lru_cache(maxsize=None)
+def manage_admins_keyboard(lang):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "admin_add_admin_button"), callback_data='admin_add_admin')],
+        [InlineKeyboardButton(get_text(lang, "admin_remove_admin_button"), callback_data='admin_remove_admin')],
+        [InlineKeyboardButton(get_text(lang, "back_button"), callback_data='menu')]
+    ])
+
+
+@lru_cache(maxsize=None)
+def back_to_manage_admins_button(lang):
+    return InlineKeyboardButton(get_text(lang, "back_button"), callback_data='admin_manage_admins')
+
+
+@lru_cache(maxsize=None)
+def back_to_manage_admins_keyboard(lang):
+    return InlineKeyboardMarkup([[back_to_manage_admins_button(lang)]])
+
+
+# Клавиатуры конкретных сделок: ограниченный кэш последних сделок
+@lru_cache(maxsize=1024)
+def deal_keyboard(lang, deal_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "pay_from_balance_button"), callback_data=f'pay_from_balance_{deal_id}')],
+        menu_keyboard(lang).inline_keyboard[0]
+    ])
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import journal
+import storage
+
+ABSENT_CACHE_SIZE = 10000  # Сколько отсутствующих ключей помнить, если размер таблицы не ограничен
+
+
+class LazyTable(MutableMapping):
+    # Словарь записей, которые подгружаются из базы по первичному ключу при первом обращении.
+    # Хранит не более maxsize записей, давно не использованные вытесняются.
+    # Незаписанные изменения берутся из журнала, чтобы не прочитать из базы устаревшую версию.
+    # Отсутствие записи тоже запоминается (не больше maxsize или ABSENT_CACHE_SIZE ключей), иначе каждое обращение
+    # к несуществующей записи, например к диалогу пользователя без диалога, читало бы базу.
+
+    def __init__(self, loader, pending, maxsize=None):
+        self._data = OrderedDict()
+        self._absent = OrderedDict()  # Ключи, которых нет в базе
+        self._absent_maxsize = maxsize if maxsize is not None else ABSENT_CACHE_SIZE
+        self._loader = loader  # Синхронная загрузка записи по ключу: запись или None
+        self._pending = pending  # Поиск записи в журнале: запись, None или journal.MISSING
+        self.maxsize = maxsize
+
+    def _put(self, key, record):
+        self._absent.pop(key, None)
+        self._data[key] = record
+        self._data.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def _put_absent(self, key):
+        self._absent[key] = None
+        self._absent.move_to_end(key)
+        while len(self._absent) > self._absent_maxsize:
+            self._absent.popitem(last=False)
+
+    def _lookup(self, key):
+        record = self._pending(key)
+        if record is journal.MISSING:
+            if key in self._absent:
+                return None
+            record = self._loader(key)
+            if record is None:
+                self._put_absent(key)
+        return record
+
+    def __getitem__(self, key):
+        if key in self._data:
+            self._data.move_to_end(key)
+            return self._data[key]
+        record = self._lookup(key)
+        if record is None:
+            raise KeyError(key)
+        self._put(key, record)
+        return record
+
+    def __setitem__(self, key, record):
+        self._put(key, record)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        del self._data[key]
+        self._put_absent(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        # Перебираются только записи, загруженные в память
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def invalidate(self, key):
+        # Запись изменена в другом процессе: при следующем обращении она будет прочитана из базы
+        self._data.pop(key, None)
+        self._absent.pop(key, None)
+
+    def load(self, records):
+        # Полная предварительная загрузка (режим без ленивой загрузки)
+        for key, record in records:
+            self._put(key, record)
+
+    async def prefetch(self, key):
+        # Подгружает запись в потоке базы данных, чтобы обработчик не читал диск в event loop
+        if key is None or key in self._data or key in self._absent or self._pending(key) is not journal.MISSING:
+            return
+        record = await storage.run_async(self._loader, key)
+        if key not in self._data and self._pending(key) is journal.MISSING:
+            if record is None:
+                self._put_absent(key)
+            else:
+                self._put(key, record)
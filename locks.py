@@ -0,0 +1,50 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager, AsyncExitStack
+
+# Блокировки по ключу: {ключ: [asyncio.Lock, число ожидающих]}
+# Запись удаляется, когда блокировку больше никто не держит и не ждёт.
+#
+# Используются два вида ключей:
+#   ('session', user_id) - обновления одного пользователя обрабатываются по очереди (per_user);
+#   ('deal', deal_id), ('user', user_id) - изменение сделки и баланса пользователя.
+# Блокировки второго вида берутся только через hold/hold_many и не вкладываются друг в друга,
+# а блокировка сессии всегда берётся первой, поэтому взаимных блокировок не возникает.
+_locks = {}
+
+
+@asynccontextmanager
+async def hold(key):
+    entry = _locks.get(key)
+    if entry is None:
+        entry = _locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[key]
+
+
+@asynccontextmanager
+async def hold_many(*keys):
+    # Берёт несколько блокировок в едином порядке, чтобы избежать взаимной блокировки
+    async with AsyncExitStack() as stack:
+        for key in sorted(set(keys)):
+            await stack.enter_async_context(hold(key))
+        yield
+
+
+def per_user(handler):
+    # Обработчик, который для одного пользователя выполняется по очереди,
+    # а для разных пользователей - параллельно (при CONCURRENT_UPDATES > 1)
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        async with hold(('session', user.id)):
+            return await handler(update, context)
+    return wrapper
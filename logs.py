@@ -0,0 +1,154 @@
+import contextlib
+import contextvars
+import copy
+import functools
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+from datetime import datetime, timezone
+
+# ------------------------------
+#  Логирование
+# ------------------------------
+# Обработчики и event loop только кладут запись в очередь (QueueHandler), а в файл и консоль
+# её пишет отдельный поток (QueueListener), поэтому медленный диск не останавливает бота.
+# В файл пишутся JSON-записи по одной на строку, с полями user_id/deal_id/route из контекста
+# текущего обновления (см. context и bind). Файл ротируется по размеру, старые части сжимаются gzip.
+# Частые INFO-записи можно прореживать: записи уровня sample_level и ниже пропускаются
+# с вероятностью 1 - sample_rate; предупреждения и ошибки не прореживаются никогда.
+CONSOLE_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+CONTEXT_FIELDS = ('user_id', 'deal_id', 'route')
+
+_context = contextvars.ContextVar('log_context', default={})
+_listener = None
+_exception_formatter = logging.Formatter()
+
+
+@contextlib.contextmanager
+def context(**fields):
+    # Поля добавляются ко всем записям внутри блока, в том числе из вложенных вызовов
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind(**fields):
+    # Добавляет поля до конца текущего блока context (или текущей задачи asyncio)
+    _context.set({**_context.get(), **fields})
+
+
+def with_user(handler):
+    # Обработчик обновления: записи внутри него получают user_id отправителя
+    @functools.wraps(handler)
+    async def wrapper(update, *args):
+        user = update.effective_user
+        with context(user_id=user.id if user else None):
+            return await handler(update, *args)
+    return wrapper
+
+
+class ContextFilter(logging.Filter):
+    # Переносит поля контекста в запись; выполняется в потоке, который пишет в лог.
+    # Поля, переданные явно через extra=, не перезаписываются.
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Пропускает записи уровня level и ниже с вероятностью rate
+
+    def __init__(self, level, rate):
+        super().__init__()
+        self.level = level
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > self.level or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Стандартный prepare дописывает traceback к тексту сообщения; здесь он остаётся
+        # отдельно (exc_text), чтобы JsonFormatter положил его в поле exc
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()  # Аргументы форматируем сразу: они могут измениться
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup(path, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5, sample_level=None, sample_rate=1.0):
+    global _listener
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    file_handler.namer = _gzip_namer
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT, DATE_FORMAT))
+
+    queue_handler = _QueueHandler(queue.SimpleQueue())
+    if sample_level is not None and sample_rate < 1.0:
+        queue_handler.addFilter(SamplingFilter(sample_level, sample_rate))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    # Дописывает оставшиеся в очереди записи и закрывает файлы
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+from telegram.error import BadRequest
+
+import backend
+import outbox
+import storage
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------
+#  Кэш file_id картинок
+# ------------------------------
+# Картинка, отправленная один раз по URL или из файла, дальше отправляется по file_id,
+# который вернул Telegram: ему не нужно заново скачивать URL, а боту - заново загружать файл.
+# Ключ кэша - источник (URL или путь). Для файла хранится отпечаток содержимого: если файл
+# изменился, он загружается заново. URL считается неизменным, новая картинка - новый URL.
+# Если Telegram не принял сохранённый file_id, запись удаляется и картинка сразу отправляется
+# заново из источника; прочие ошибки отправки (сеть, остановка бота) кэш не трогают.
+
+_file_ids = {}  # {источник: (отпечаток, file_id)}
+_file_hashes = {}  # {путь: ((размер, mtime), sha256)} - чтобы не хешировать файл на каждую отправку
+_tasks = set()
+
+
+def _is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+
+def fingerprint(source):
+    if _is_url(source):
+        return source
+    stat = os.stat(source)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = _file_hashes.get(source)
+    if cached is None or cached[0] != key:
+        cached = _file_hashes[source] = (key, hashlib.sha256(Path(source).read_bytes()).hexdigest())
+    return cached[1]
+
+
+def load():
+    # Синхронная загрузка сохранённых file_id при запуске
+    for source, source_fingerprint, file_id in backend.get().load_media():
+        _file_ids[source] = (source_fingerprint, file_id)
+
+
+def cached_file_id(source):
+    # file_id для источника или None, если картинки нет в кэше или она изменилась
+    cached = _file_ids.get(source)
+    if cached is None:
+        return None
+    try:
+        current = fingerprint(source)
+    except OSError:
+        return cached[1]  # Файла больше нет, но загруженная картинка по-прежнему доступна
+    return cached[1] if cached[0] == current else None
+
+
+def _photo_input(source):
+    return source if _is_url(source) else Path(source)
+
+
+def _is_file_rejected(error):
+    # Telegram не принял сам file_id (а не чат, подпись и т. п.): "Wrong file identifier..."
+    return isinstance(error, BadRequest) and 'file' in error.message.lower()
+
+
+async def _remember(source, message):
+    file_id = message.photo[-1].file_id
+    source_fingerprint = fingerprint(source)
+    _file_ids[source] = (source_fingerprint, file_id)
+    await storage.run_async(backend.get().save_media, source, source_fingerprint, file_id)
+
+
+async def _deliver(bot, chat_id, source, priority, kwargs, file_id, future, result):
+    message = None
+    try:
+        try:
+            message = await future
+        except Exception as e:
+            if file_id is None or not _is_file_rejected(e):
+                return  # Ошибку уже записал outbox; сохранённый file_id по-прежнему годен
+            # Telegram отверг сохранённый file_id: забываем его и сразу отправляем картинку из источника
+            logger.warning(f"Telegram не принял сохранённый file_id картинки {source}, загружаем её заново")
+            _file_ids.pop(source, None)
+            file_id = None
+            resend = outbox.send_photo(bot, chat_id, _photo_input(source), priority=priority, **kwargs)
+            await storage.run_async(backend.get().delete_media, source)
+            message = await resend
+        if message is not None and file_id is None and message.photo:
+            await _remember(source, message)
+    except Exception as e:
+        logger.error(f"Ошибка кэша картинки {source}: {e}")
+    finally:
+        if not result.done():
+            result.set_result(message)
+
+
+def send_photo(bot, chat_id, source, priority=outbox.Priority.NORMAL, **kwargs):
+    # Как outbox.send_photo, но по file_id из кэша; после первой отправки file_id сохраняется.
+    # Возвращает future с отправленным сообщением или None.
+    file_id = cached_file_id(source)
+    future = outbox.send_photo(bot, chat_id, file_id or _photo_input(source), priority=priority, raise_errors=True, **kwargs)
+    result = future.get_loop().create_future()
+    task = asyncio.ensure_future(_deliver(bot, chat_id, source, priority, kwargs, file_id, future, result))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return result
+
+
+async def preload(bot, sources, chat_id):
+    # Загружает картинки, которых нет в кэше, отправкой в служебный чат chat_id
+    # (например, личный чат админа), чтобы пользователи сразу получали их по file_id
+    for source in sources:
+        if cached_file_id(source) is not None:
+            continue
+        try:
+            message = await send_photo(bot, chat_id, source, priority=outbox.Priority.BROADCAST)
+            if message is not None:
+                await bot.delete_message(chat_id, message.message_id)
+                logger.info(f"Картинка {source} загружена в Telegram")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке картинки {source}: {e}")
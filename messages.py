@@ -1,3 +1,5 @@
+from string import Formatter
+
 # Тексты на русском языке
 RU_TEXTS = {
     "start_message": (
@@ -54,6 +56,11 @@ RU_TEXTS = {
         "⚠️ Проверьте, что это тот же пользователь, с которым вы вели диалог ранее!"
     ),
     "insufficient_balance_message": "❌ Недостаточно средств на балансе!",
+    "deal_expired_message": (
+        "⌛ Сделка #{deal_id} отменена: покупатель не открыл ссылку в течение {days} дн.\n\n"
+        "💰 Сумма: {amount} {valute}\n"
+        "📜 Описание: {description}"
+    ),
     "wallet_updated_message": "💼 Ваш кошелек обновлен: {wallet}",
     "admin_panel_message": "Админ-панель:",
     "admin_view_deals_message": "Активные сделки:\n{deals_list}",
@@ -147,6 +154,11 @@ EN_TEXTS = {
         "⚠️ Make sure this is the same user you were talking to earlier!"
     ),
     "insufficient_balance_message": "❌ Insufficient balance!",
+    "deal_expired_message": (
+        "⌛ Deal #{deal_id} was cancelled: no buyer opened the link within {days} days.\n\n"
+        "💰 Amount: {amount} {valute}\n"
+        "📜 Description: {description}"
+    ),
     "wallet_updated_message": "💼 Your wallet has been updated: {wallet}",
     "admin_panel_message": "Admin panel:",
     "admin_view_deals_message": "Active deals:\n{deals_list}",
@@ -184,10 +196,63 @@ EN_TEXTS = {
     ),
 }
 
+# ------------------------------
+#  Реестр шаблонов
+# ------------------------------
+# Тексты без параметров хранятся уже готовыми строками. Шаблоны с параметрами разбираются
+# один раз при регистрации на куски текста и поля, при вызове остаётся только подставить
+# значения и склеить строку. Новый язык добавляется через register_language.
+
+_static_texts = {}  # {(lang, key): готовая строка}
+_formatters = {}  # {(lang, key): функция, собирающая текст из параметров}
+_CONVERSIONS = {None: None, 's': str, 'r': repr, 'a': ascii}  # {!s}, {!r}, {!a} в шаблоне
+
+
+def _has_fields(template):
+    return any(field is not None for _, field, _, _ in Formatter().parse(template))
+
+
+def _compile(template):
+    # [(текст, поле, формат, преобразование)] в порядке следования в шаблоне
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if field is not None and (not field.isidentifier() or '{' in spec):
+            return template.format  # Поля вида {a.b}, {a[0]}, {} и вложенные форматы разбирает str.format
+        parts.append((literal, field, spec, _CONVERSIONS[conversion]))
+
+    def render(**kwargs):
+        pieces = []
+        for literal, field, spec, convert in parts:
+            pieces.append(literal)
+            if field is not None:
+                value = kwargs[field]
+                if convert is not None:
+                    value = convert(value)
+                pieces.append(format(value, spec))
+        return ''.join(pieces)
+    return render
+
+
+def register_language(lang, texts):
+    for key, template in texts.items():
+        if _has_fields(template):
+            _formatters[(lang, key)] = _compile(template)
+            _static_texts.pop((lang, key), None)
+        else:
+            _static_texts[(lang, key)] = template.format()  # Раскрываем {{ }} так же, как format
+            _formatters.pop((lang, key), None)
+
+
+register_language('ru', RU_TEXTS)
+register_language('en', EN_TEXTS)
+
+
 # Функция для получения текста на выбранном языке
 def get_text(lang, key, **kwargs):
-    if lang == 'ru':
-        return RU_TEXTS.get(key, '').format(**kwargs)
-    elif lang == 'en':
-        return EN_TEXTS.get(key, '').format(**kwargs)
+    text = _static_texts.get((lang, key))
+    if text is not None:
+        return text
+    formatter = _formatters.get((lang, key))
+    if formatter is not None:
+        return formatter(**kwargs)
     return ''
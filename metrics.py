@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------
+#  Метрики
+# ------------------------------
+# Время обработчиков, маршрутов кнопок, состояний диалога, операций с базой и запросов
+# к Bot API - гистограммы и счётчики ошибок. Отдаются в текстовом формате Prometheus
+# по HTTP (GET /metrics) на локальном адресе.
+# Пока метрики не включены (enable), обёртки не ставятся: timed возвращает функцию как есть,
+# бэкенд и HTTP-клиент Telegram не подменяются, а в router.dispatch и handle_message
+# остаётся одна проверка ENABLED.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ENABLED = False
+
+
+class Timing:
+    # Гистограмма длительностей <name>_seconds и счётчик ошибок <name>_errors_total
+    # с одной меткой label. Пишется и из event loop, и из потока базы данных.
+
+    def __init__(self, name, label, help_text, buckets=BUCKETS):
+        self.name = name
+        self.label = label
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}  # {значение метки: [счётчики по корзинам..., сумма, число, ошибки]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, seconds, failed=False):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [0] * len(self.buckets) + [0, 0.0, 0, 0]
+            series[index] += 1
+            series[-3] += seconds
+            series[-2] += 1
+            if failed:
+                series[-1] += 1
+
+    @contextlib.contextmanager
+    def _time(self, value):
+        started = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.observe(value, time.perf_counter() - started, failed)
+
+    def time(self, value):
+        # with timing.time('метка'): ... - без метрик ничего не замеряет
+        return self._time(value) if ENABLED else contextlib.nullcontext()
+
+    def render(self, lines):
+        with self._lock:
+            snapshot = {value: list(series) for value, series in self._series.items()}
+        lines.append(f"# HELP {self.name}_seconds {self.help_text}")
+        lines.append(f"# TYPE {self.name}_seconds histogram")
+        for value, series in sorted(snapshot.items()):
+            label = f'{self.label}="{_escape(value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_seconds_bucket{{{label},le="+Inf"}} {series[-2]}')
+            lines.append(f"{self.name}_seconds_sum{{{label}}} {series[-3]}")
+            lines.append(f"{self.name}_seconds_count{{{label}}} {series[-2]}")
+        lines.append(f"# HELP {self.name}_errors_total {self.help_text}: ошибки")
+        lines.append(f"# TYPE {self.name}_errors_total counter")
+        for value, series in sorted(snapshot.items()):
+            lines.append(f'{self.name}_errors_total{{{self.label}="{_escape(value)}"}} {series[-1]}')
+
+
+HANDLERS = Timing('bot_handler', 'handler', "Время обработчиков обновлений")
+ROUTES = Timing('bot_route', 'route', "Время обработчиков кнопок")
+STATES = Timing('bot_state', 'state', "Время обработчиков состояний диалога")
+DB = Timing('bot_db', 'operation', "Время операций с базой данных")
+TELEGRAM = Timing('bot_telegram', 'method', "Время запросов к Bot API")
+
+_timings = (HANDLERS, ROUTES, STATES, DB, TELEGRAM)
+
+# (имя, ключ в outbox.stats, тип, описание)
+_OUTBOX_METRICS = (
+    ('bot_outbox_enqueued_total', 'enqueued', 'counter', "Поставлено в очередь отправки"),
+    ('bot_outbox_sent_total', 'sent', 'counter', "Доставлено"),
+    ('bot_outbox_failed_total', 'failed', 'counter', "Не доставлено"),
+    ('bot_outbox_retried_total', 'retried', 'counter', "Повторов отправки"),
+    ('bot_outbox_flood_waits_total', 'flood_waits', 'counter', "Ответов RetryAfter"),
+    ('bot_outbox_latency_seconds_total', 'total', 'counter', "Суммарное время от постановки в очередь до доставки"),
+    ('bot_outbox_latency_seconds_max', 'max', 'gauge', "Наибольшее время от постановки в очередь до доставки"),
+)
+
+_server = None
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def enable():
+    # Вызывается при запуске до регистрации обработчиков и установки бэкенда
+    global ENABLED
+    ENABLED = True
+
+
+def timed(timing, value):
+    # Декоратор для async-функций; без метрик возвращает функцию без изменений
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timing._time(value):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class TimedBackend:
+    # Обёртка над StateBackend: время каждого вызова в bot_db_seconds{operation=...}.
+    # Замеряется сам вызов в потоке базы, без ожидания в очереди storage.run_async.
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def wrapper(*args, **kwargs):
+            with DB._time(name):
+                return attr(*args, **kwargs)
+        setattr(self, name, wrapper)  # Следующие вызовы не проходят через __getattr__
+        return wrapper
+
+
+class TelegramRequest(HTTPXRequest):
+    # HTTP-клиент Bot API, который замеряет каждый запрос: метка - метод Bot API (sendMessage и т. п.).
+    # Ошибкой считается и ответ с кодом 4xx/5xx.
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        started = time.perf_counter()
+        failed = True
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            failed = code >= 400
+            return code, payload
+        finally:
+            # В url есть токен бота: в метку попадает только имя метода
+            TELEGRAM.observe(url.rsplit('/', 1)[-1], time.perf_counter() - started, failed)
+
+
+def render():
+    lines = []
+    for timing in _timings:
+        timing.render(lines)
+
+    # Очередь исходящих сообщений (outbox.stats)
+    for name, key, kind, help_text in _OUTBOX_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for priority, priority_stats in outbox.stats.items():
+            lines.append(f'{name}{{priority="{priority}"}} {priority_stats[key]}')
+    lines.append("# HELP bot_outbox_queue_size Сообщений ждут отправки")
+    lines.append("# TYPE bot_outbox_queue_size gauge")
+    lines.append(f"bot_outbox_queue_size {outbox.size()}")
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass  # Заголовки запроса не нужны
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', render().encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка при отдаче метрик: {e}")
+    finally:
+        writer.close()
+
+
+async def start_server(host, port):
+    global _server
+    _server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
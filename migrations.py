@@ -0,0 +1,360 @@
+import logging
+import time
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------
+#  Миграции схемы базы данных
+# ------------------------------
+# Номер применённой миграции хранится в PRAGMA user_version. При запуске все недостающие
+# миграции выполняются по порядку в одной транзакции: либо схема обновляется целиком,
+# либо остаётся прежней. Новые миграции только добавляются в конец MIGRATIONS.
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _rebuild(conn, table, create_sql, columns, select_sql):
+    # SQLite не меняет тип столбца через ALTER TABLE: создаём новую таблицу,
+    # переносим данные и подменяем старую
+    conn.execute(create_sql.format(table=f'{table}_new'))
+    conn.execute(f'INSERT INTO {table}_new ({columns}) {select_sql}')
+    conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+
+def _initial_schema(conn):
+    # Схема, которую раньше создавала init_db. Базы, созданные до появления миграций,
+    # уже содержат эти таблицы, поэтому всё создаётся только при отсутствии.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            wallet TEXT,
+            balance REAL,
+            successful_deals INTEGER,
+            lang TEXT
+        )
+    ''')
+    if 'lang' not in _columns(conn, 'users'):
+        conn.execute('ALTER TABLE users ADD COLUMN lang TEXT DEFAULT "ru"')
+
+    conn.execute('CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY)')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deals (
+            deal_id TEXT PRIMARY KEY,
+            amount REAL,
+            description TEXT,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            created_at INTEGER DEFAULT 0
+        )
+    ''')
+    if 'created_at' not in _columns(conn, 'deals'):
+        conn.execute('ALTER TABLE deals ADD COLUMN created_at INTEGER DEFAULT 0')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS settlements (
+            idempotency_key TEXT PRIMARY KEY,
+            deal_id TEXT UNIQUE,
+            buyer_id INTEGER,
+            seller_id INTEGER,
+            amount REAL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS usernames (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            updated_at REAL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT,
+            amount REAL,
+            updated_at REAL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT,
+            kind TEXT,
+            key TEXT,
+            created_at REAL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_changes_created_at ON changes (created_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            version INTEGER
+        )
+    ''')
+
+
+def _money_and_deal_status(conn):
+    # Суммы переводятся из REAL в целые минимальные единицы (storage.MINOR_UNITS),
+    # у сделок появляются статус и время последнего изменения
+    scale = storage.MINOR_UNITS
+    now = int(time.time())
+
+    _rebuild(conn, 'users', '''
+        CREATE TABLE {table} (
+            user_id INTEGER PRIMARY KEY,
+            wallet TEXT NOT NULL DEFAULT '',
+            balance INTEGER NOT NULL DEFAULT 0,
+            successful_deals INTEGER NOT NULL DEFAULT 0,
+            lang TEXT NOT NULL DEFAULT 'ru'
+        )
+    ''', 'user_id, wallet, balance, successful_deals, lang', f'''
+        SELECT user_id, COALESCE(wallet, ''), CAST(ROUND(COALESCE(balance, 0) * {scale}) AS INTEGER),
+               COALESCE(successful_deals, 0), COALESCE(lang, 'ru')
+        FROM users
+    ''')
+
+    # rowid сделок переносится явно: по нему идёт постраничный просмотр
+    _rebuild(conn, 'deals', '''
+        CREATE TABLE {table} (
+            deal_id TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL,
+            description TEXT,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'open',
+            created_at INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL DEFAULT 0
+        )
+    ''', 'rowid, deal_id, amount, description, seller_id, buyer_id, status, created_at, updated_at', f'''
+        SELECT rowid, deal_id, CAST(ROUND(COALESCE(amount, 0) * {scale}) AS INTEGER), description, seller_id,
+               buyer_id, CASE WHEN buyer_id IS NULL THEN 'open' ELSE 'joined' END,
+               COALESCE(created_at, 0), MAX(COALESCE(created_at, 0), {now})
+        FROM deals
+    ''')
+    conn.execute('CREATE INDEX idx_deals_seller_id ON deals (seller_id)')
+    conn.execute('CREATE INDEX idx_deals_buyer_id ON deals (buyer_id)')
+    conn.execute('CREATE INDEX idx_deals_created_at ON deals (created_at)')
+    conn.execute('CREATE INDEX idx_deals_status_created_at ON deals (status, created_at)')
+
+    _rebuild(conn, 'settlements', '''
+        CREATE TABLE {table} (
+            idempotency_key TEXT PRIMARY KEY,
+            deal_id TEXT UNIQUE,
+            buyer_id INTEGER,
+            seller_id INTEGER,
+            amount INTEGER NOT NULL,
+            created_at INTEGER NOT NULL DEFAULT 0
+        )
+    ''', 'idempotency_key, deal_id, buyer_id, seller_id, amount', f'''
+        SELECT idempotency_key, deal_id, buyer_id, seller_id, CAST(ROUND(COALESCE(amount, 0) * {scale}) AS INTEGER)
+        FROM settlements
+    ''')
+    conn.execute('CREATE INDEX idx_settlements_buyer_id ON settlements (buyer_id)')
+    conn.execute('CREATE INDEX idx_settlements_seller_id ON settlements (seller_id)')
+
+    _rebuild(conn, 'conversations', '''
+        CREATE TABLE {table} (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            amount INTEGER,
+            updated_at REAL NOT NULL DEFAULT 0
+        )
+    ''', 'user_id, state, amount, updated_at', f'''
+        SELECT user_id, state, CAST(ROUND(amount * {scale}) AS INTEGER), COALESCE(updated_at, 0)
+        FROM conversations
+        WHERE state IS NOT NULL
+    ''')
+    # Устаревшие состояния удаляются по времени обновления
+    conn.execute('CREATE INDEX idx_conversations_updated_at ON conversations (updated_at)')
+
+
+def _deal_history(conn):
+    # Завершённые сделки переносятся в неизменяемую таблицу deal_history, а число успешных
+    # сделок продавца ведётся счётчиком в seller_stats, который обновляется при расчёте
+    conn.execute('''
+        CREATE TABLE deal_history (
+            deal_id TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL,
+            description TEXT,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL DEFAULT 0,
+            closed_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_deal_history_seller_id ON deal_history (seller_id, closed_at)')
+    conn.execute('CREATE INDEX idx_deal_history_buyer_id ON deal_history (buyer_id, closed_at)')
+    # Изменять и удалять записи истории запрещено самой базой
+    conn.execute('''
+        CREATE TRIGGER deal_history_no_update BEFORE UPDATE ON deal_history
+        BEGIN SELECT RAISE(ABORT, 'deal_history is append-only'); END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER deal_history_no_delete BEFORE DELETE ON deal_history
+        BEGIN SELECT RAISE(ABORT, 'deal_history is append-only'); END
+    ''')
+
+    conn.execute('''
+        CREATE TABLE seller_stats (
+            seller_id INTEGER PRIMARY KEY,
+            successful_deals INTEGER NOT NULL DEFAULT 0,
+            volume INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Оплаченные раньше сделки удалялись; восстанавливаем их из settlements без описания
+    conn.execute('''
+        INSERT INTO deal_history (deal_id, amount, seller_id, buyer_id, status, created_at, closed_at)
+        SELECT deal_id, amount, seller_id, buyer_id, 'paid', created_at, created_at
+        FROM settlements
+        WHERE deal_id IS NOT NULL
+    ''')
+    # Счётчик берём из users: в нём могут быть исправления админа, которых нет в settlements
+    conn.execute('''
+        INSERT INTO seller_stats (seller_id, successful_deals, volume)
+        SELECT user_id, successful_deals,
+               (SELECT COALESCE(SUM(amount), 0) FROM settlements WHERE seller_id = users.user_id)
+        FROM users
+        WHERE successful_deals > 0
+           OR user_id IN (SELECT seller_id FROM settlements)
+    ''')
+    # Столбец successful_deals больше не нужен (DROP COLUMN есть не во всех версиях SQLite)
+    _rebuild(conn, 'users', '''
+        CREATE TABLE {table} (
+            user_id INTEGER PRIMARY KEY,
+            wallet TEXT NOT NULL DEFAULT '',
+            balance INTEGER NOT NULL DEFAULT 0,
+            lang TEXT NOT NULL DEFAULT 'ru'
+        )
+    ''', 'user_id, wallet, balance, lang', 'SELECT user_id, wallet, balance, lang FROM users')
+
+
+def _ledger(conn):
+    # Журнал переводов (двойная запись): каждая строка списывает amount со счёта from_account
+    # и зачисляет на to_account. Счёт - user_id или storage.SYSTEM_ACCOUNT для денег, которые
+    # приходят извне и уходят наружу (оплата админом, ручное изменение баланса).
+    # users.balance - материализованная сумма журнала по счёту, обновляется в той же транзакции.
+    conn.execute('''
+        CREATE TABLE ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reference TEXT,
+            from_account INTEGER NOT NULL,
+            to_account INTEGER NOT NULL,
+            amount INTEGER NOT NULL CHECK (amount > 0)
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_ledger_from_account ON ledger (from_account, id)')
+    conn.execute('CREATE INDEX idx_ledger_to_account ON ledger (to_account, id)')
+    conn.execute('''
+        CREATE TRIGGER ledger_no_update BEFORE UPDATE ON ledger
+        BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER ledger_no_delete BEFORE DELETE ON ledger
+        BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+    ''')
+
+    # Снимки балансов: остатки всех счетов после записи ledger_id. Проверка журнала
+    # начинается с последнего снимка, а не с первой записи.
+    conn.execute('''
+        CREATE TABLE balance_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ledger_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE balance_snapshot_entries (
+            snapshot_id INTEGER NOT NULL,
+            account INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_id, account)
+        ) WITHOUT ROWID
+    ''')
+
+    # Текущие балансы истории не имеют: записываем их входящими остатками
+    conn.execute(f'''
+        INSERT INTO ledger (created_at, kind, reference, from_account, to_account, amount)
+        SELECT {int(time.time())}, 'opening', NULL,
+               CASE WHEN balance > 0 THEN {storage.SYSTEM_ACCOUNT} ELSE user_id END,
+               CASE WHEN balance > 0 THEN user_id ELSE {storage.SYSTEM_ACCOUNT} END,
+               ABS(balance)
+        FROM users
+        WHERE balance != 0
+        ORDER BY user_id
+    ''')
+
+
+def _media_cache(conn):
+    # file_id загруженных в Telegram картинок по источнику (URL или путь к файлу);
+    # fingerprint - отпечаток содержимого, при его смене файл загружается заново
+    conn.execute('''
+        CREATE TABLE media (
+            source TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _deal_created_at(conn):
+    # Сделки, созданные до появления created_at, хранят 0 и выглядели бы просроченными
+    # для отмены по DEAL_TTL_DAYS. Считаем их созданными в момент миграции 2 (updated_at),
+    # чтобы срок отсчитывался с обновления бота, а не с 1970 года.
+    conn.execute(
+        'UPDATE deals SET created_at = COALESCE(NULLIF(updated_at, 0), ?) WHERE created_at = 0',
+        (int(time.time()),)
+    )
+
+
+# (номер, описание, функция миграции)
+MIGRATIONS = [
+    (1, 'начальная схема', _initial_schema),
+    (2, 'суммы в минимальных единицах, статус и время изменения сделок', _money_and_deal_status),
+    (3, 'история завершённых сделок и счётчики продавцов', _deal_history),
+    (4, 'журнал переводов и снимки балансов', _ledger),
+    (5, 'кэш file_id картинок', _media_cache),
+    (6, 'время создания старых сделок', _deal_created_at),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def run(conn):
+    # Применяет недостающие миграции одной транзакцией; возвращает номер версии схемы
+    if current_version(conn) >= MIGRATIONS[-1][0]:
+        return current_version(conn)
+
+    started = time.perf_counter()
+    # BEGIN IMMEDIATE сразу берёт блокировку записи: если несколько процессов запускаются
+    # одновременно, миграции выполнит первый, остальные увидят уже новую версию
+    conn.execute('BEGIN IMMEDIATE')
+    version = current_version(conn)
+    try:
+        pending = [migration for migration in MIGRATIONS if migration[0] > version]
+        for number, description, migrate in pending:
+            step_started = time.perf_counter()
+            migrate(conn)
+            logger.info(f"Миграция {number} ({description}) выполнена за {(time.perf_counter() - step_started) * 1000:.1f} мс")
+        if pending:
+            conn.execute(f'PRAGMA user_version = {pending[-1][0]}')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Ошибка миграции схемы, база оставлена в версии {version}: {e}")
+        raise
+    if pending:
+        logger.info(f"Схема базы обновлена с версии {version} до {pending[-1][0]} за {(time.perf_counter() - started) * 1000:.1f} мс")
+    return current_version(conn)
@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import timedelta
+from enum import IntEnum
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------
+#  Очередь исходящих сообщений
+# ------------------------------
+# Обработчики ставят отправку в очередь и сразу продолжают работу; доставкой занимаются
+# WORKERS фоновых задач. Соблюдаются лимиты Bot API: общий и на каждый чат (token bucket).
+# Сообщения одного чата отправляются по одному, в порядке приоритета, при равном - в порядке
+# постановки. На RetryAfter (flood wait) отправка откладывается на указанное Telegram время,
+# на сетевые ошибки - повторяется с экспоненциальной задержкой.
+WORKERS = 8
+GLOBAL_RATE = 30  # Сообщений в секунду на бота
+GLOBAL_BURST = 30
+PER_CHAT_RATE = 1.0  # Сообщений в секунду в один чат
+PER_CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без паузы
+MAX_ATTEMPTS = 5  # Попыток доставки одного сообщения
+RETRY_BACKOFF = 1.0  # Первая пауза перед повтором после сетевой ошибки, дальше удваивается
+
+
+class Priority(IntEnum):
+    # Чем меньше значение, тем раньше отправляется
+    PAYMENT = 0  # Подтверждения оплаты
+    NORMAL = 1  # Ответы на действия пользователя
+    BROADCAST = 2  # Рассылки админам, уведомления фоновых задач
+
+
+class TokenBucket:
+    # Запас токенов пополняется со скоростью rate в секунду, но не больше burst
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = None
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now):
+        # Через сколько секунд появится токен
+        self._refill(now)
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def reserve(self, now):
+        # Забирает токен (запас может уйти в минус); возвращает, сколько ждать до отправки
+        self._refill(now)
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, now, seconds):
+        # Flood wait: следующий токен появится не раньше чем через seconds
+        self._refill(now)
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def idle(self, now):
+        self._refill(now)
+        return self._tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'method', 'args', 'kwargs', 'future', 'raise_errors', 'enqueued_at', 'not_before', 'attempts')
+
+    def __init__(self, priority, seq, method, args, kwargs, future, raise_errors, now):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.raise_errors = raise_errors
+        self.enqueued_at = now
+        self.not_before = now
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# Метрики доставки по приоритетам: total/max - время от постановки в очередь до доставки
+stats = {
+    priority.name: {'enqueued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'flood_waits': 0, 'total': 0.0, 'max': 0.0}
+    for priority in Priority
+}
+
+_seq = itertools.count()
+_loop = None
+_ready = None  # Очередь чатов, готовых к отправке: (приоритет, номер, chat_id)
+_workers = []
+_lanes = {}  # {chat_id: куча _Job} - неотправленные сообщения чата
+_queued = set()  # Чаты, которые стоят в _ready или ждут паузы
+_in_flight = set()  # Чаты, сообщение в которые отправляется прямо сейчас
+_chat_buckets = {}
+_global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+
+
+def _ensure_started():
+    global _loop, _ready, _workers
+    loop = asyncio.get_running_loop()
+    if _loop is loop:
+        return
+    # Первый вызов (или новый event loop): очередь и задачи привязаны к циклу событий
+    _loop = loop
+    _ready = asyncio.PriorityQueue()
+    _lanes.clear()
+    _queued.clear()
+    _in_flight.clear()
+    _workers = [loop.create_task(_worker()) for _ in range(WORKERS)]
+
+
+def _chat_bucket(chat_id, now):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        # Не даём словарю расти бесконечно: удаляем чаты, для которых лимит уже восстановился
+        if len(_chat_buckets) > 10000:
+            for idle_id in [cid for cid, b in _chat_buckets.items() if b.idle(now)]:
+                del _chat_buckets[idle_id]
+        bucket = _chat_buckets[chat_id] = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+    return bucket
+
+
+def _push(chat_id):
+    lane = _lanes.get(chat_id)
+    if lane and chat_id not in _in_flight:
+        _ready.put_nowait((lane[0].priority, lane[0].seq, chat_id))
+    else:
+        _queued.discard(chat_id)
+
+
+def _schedule(chat_id, delay):
+    _queued.add(chat_id)
+    if delay > 0:
+        _loop.call_later(delay, _push, chat_id)
+    else:
+        _push(chat_id)
+
+
+def enqueue(chat_id, method, *args, priority=Priority.NORMAL, raise_errors=False, **kwargs):
+    # Ставит вызов метода Bot API в очередь. Возвращает future с результатом вызова
+    # (None, если сообщение доставить не удалось); ждать его не обязательно.
+    # С raise_errors=True future вместо None получает исключение последней попытки.
+    _ensure_started()
+    now = _loop.time()
+    future = _loop.create_future()
+    job = _Job(priority, next(_seq), method, args, kwargs, future, raise_errors, now)
+    heapq.heappush(_lanes.setdefault(chat_id, []), job)
+    stats[priority.name]['enqueued'] += 1
+    if chat_id not in _queued and chat_id not in _in_flight:
+        _schedule(chat_id, 0)
+    return future
+
+
+def send_message(bot, chat_id, text, priority=Priority.NORMAL, raise_errors=False, **kwargs):
+    return enqueue(chat_id, bot.send_message, chat_id, text, priority=priority, raise_errors=raise_errors, **kwargs)
+
+
+def send_photo(bot, chat_id, photo, priority=Priority.NORMAL, raise_errors=False, **kwargs):
+    return enqueue(chat_id, bot.send_photo, chat_id, photo, priority=priority, raise_errors=raise_errors, **kwargs)
+
+
+def edit_message_text(query, text, priority=Priority.NORMAL, raise_errors=False, **kwargs):
+    # Правка сообщения с кнопками идёт через ту же очередь чата, что и новые сообщения,
+    # иначе она могла бы обогнать ещё не отправленные сообщения этого чата
+    chat_id = query.message.chat_id
+    return enqueue(chat_id, query.edit_message_text, text, priority=priority, raise_errors=raise_errors, **kwargs)
+
+
+async def _worker():
+    while True:
+        _, _, chat_id = await _ready.get()
+        try:
+            await _deliver(chat_id)
+        except Exception as e:
+            logger.error(f"Ошибка очереди отправки для чата {chat_id}: {e}")
+        finally:
+            _ready.task_done()
+
+
+async def _deliver(chat_id):
+    _queued.discard(chat_id)
+    lane = _lanes.get(chat_id)
+    if not lane or chat_id in _in_flight:
+        return
+    job = lane[0]
+    now = _loop.time()
+    wait = max(_chat_bucket(chat_id, now).delay(now), job.not_before - now)
+    if wait > 0:
+        _schedule(chat_id, wait)  # Лимит чата: вернёмся к нему позже, не занимая обработчик
+        return
+
+    heapq.heappop(lane)
+    _in_flight.add(chat_id)
+    _chat_bucket(chat_id, now).reserve(now)
+    priority_stats = stats[job.priority.name]
+    try:
+        delay = _global_bucket.reserve(now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        job.attempts += 1
+        result = await job.method(*job.args, **job.kwargs)
+    except RetryAfter as e:
+        retry_after = e.retry_after
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        # Flood wait ограничивает весь бот: останавливаем все отправки на это время
+        _global_bucket.pause(_loop.time(), retry_after)
+        priority_stats['flood_waits'] += 1
+        logger.warning(f"Flood wait {retry_after} с при отправке в чат {chat_id}")
+        _retry(chat_id, job, retry_after, e)
+    except (BadRequest, Forbidden) as e:
+        _fail(job, chat_id, e)  # Повтор не поможет: бот заблокирован, чат не найден и т. п.
+    except NetworkError as e:
+        _retry(chat_id, job, RETRY_BACKOFF * 2 ** (job.attempts - 1), e)
+    except Exception as e:
+        _fail(job, chat_id, e)
+    else:
+        latency = _loop.time() - job.enqueued_at
+        priority_stats['sent'] += 1
+        priority_stats['total'] += latency
+        priority_stats['max'] = max(priority_stats['max'], latency)
+        if not job.future.done():
+            job.future.set_result(result)
+    finally:
+        _in_flight.discard(chat_id)
+        if lane:
+            if chat_id not in _queued:
+                _schedule(chat_id, 0)
+        else:
+            _lanes.pop(chat_id, None)
+
+
+def _retry(chat_id, job, delay, error):
+    if job.attempts >= MAX_ATTEMPTS:
+        _fail(job, chat_id, error)
+        return
+    stats[job.priority.name]['retried'] += 1
+    job.not_before = _loop.time() + delay
+    heapq.heappush(_lanes[chat_id], job)
+
+
+def _fail(job, chat_id, error):
+    stats[job.priority.name]['failed'] += 1
+    logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {error}")
+    if job.future.done():
+        return
+    if job.raise_errors:
+        job.future.set_exception(error)
+    else:
+        job.future.set_result(None)
+
+
+def size():
+    # Сколько сообщений ждут отправки
+    return sum(len(lane) for lane in _lanes.values())
+
+
+async def throttle():
+    # Ожидание своей очереди для прочих запросов к Bot API (например, get_chat):
+    # они расходуют тот же общий лимит, что и отправка сообщений
+    delay = _global_bucket.reserve(asyncio.get_running_loop().time())
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def close(timeout=10.0):
+    # Дожидается отправки поставленных сообщений (не дольше timeout) и останавливает обработчики
+    global _loop
+    if _loop is None:
+        return
+    deadline = _loop.time() + timeout
+    while (_lanes or _in_flight) and _loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    if _lanes:
+        logger.warning(f"Не отправлено сообщений при остановке: {size()}")
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
+    _loop = None
@@ -0,0 +1,43 @@
+from dataclasses import dataclass, replace
+from enum import Enum
+
+# Компактные записи пользователей и сделок: __slots__ вместо словаря на каждую запись
+
+
+@dataclass(slots=True)
+class User:
+    wallet: str = ''
+    balance: float = 0.0
+    successful_deals: int = 0
+    lang: str = 'ru'
+
+
+class DealStatus(str, Enum):
+    # Активные сделки (таблица deals): open - ждёт покупателя, joined - покупатель открыл ссылку.
+    # Завершённые переносятся в таблицу deal_history: paid - оплачена, cancelled - отменена.
+    OPEN = 'open'
+    JOINED = 'joined'
+    PAID = 'paid'
+    CANCELLED = 'cancelled'
+
+
+@dataclass(slots=True)
+class Deal:
+    amount: float = 0.0
+    description: str = ''
+    seller_id: int = None
+    buyer_id: int = None
+    created_at: int = 0
+    status: str = DealStatus.OPEN.value
+
+
+@dataclass(slots=True)
+class Conversation:
+    state: str
+    amount: float = None  # Сумма создаваемой сделки
+    updated_at: float = 0.0
+
+
+def snapshot(record):
+    # Копия записи для передачи в поток базы данных
+    return replace(record)
@@ -0,0 +1,89 @@
+import time
+from dataclasses import dataclass
+
+import logs
+import metrics
+
+# Маршрутизация callback_data кнопок: точные значения ищутся в словаре за O(1),
+# параметризованные (prefix + аргумент) - в префиксном дереве по самому длинному префиксу.
+
+_HANDLER = object()  # Ключ узла дерева, под которым хранится маршрут
+
+_exact = {}  # {callback_data: (маршрут, обработчик, только для админов)}
+_prefixes = {}  # Префиксное дерево: {символ: {...}, _HANDLER: (маршрут, обработчик, только для админов)}
+
+# Счётчики по маршрутам: {маршрут: {'calls': int, 'errors': int, 'total': сек, 'max': сек}}
+stats = {}
+
+
+@dataclass(slots=True)
+class Callback:
+    query: object
+    user_id: int
+    chat_id: int
+    lang: str
+    arg: str = ''  # Часть callback_data после префикса
+
+
+def exact(data, admin_only=False):
+    def register(handler):
+        _exact[data] = (data, handler, admin_only)
+        return handler
+    return register
+
+
+def prefix(data_prefix, admin_only=False):
+    def register(handler):
+        node = _prefixes
+        for char in data_prefix:
+            node = node.setdefault(char, {})
+        node[_HANDLER] = (data_prefix + '*', handler, admin_only)
+        return handler
+    return register
+
+
+def resolve(data):
+    # Возвращает (маршрут, обработчик, только для админов, аргумент) или None
+    route = _exact.get(data)
+    if route is not None:
+        return (*route, '')
+    found = None
+    node = _prefixes
+    for i, char in enumerate(data):
+        node = node.get(char)
+        if node is None:
+            break
+        if _HANDLER in node:
+            found = (*node[_HANDLER], data[i + 1:])
+    return found
+
+
+async def dispatch(update, context, callback, is_admin):
+    # Вызывает обработчик для callback.query.data; возвращает False, если маршрут не найден
+    resolved = resolve(callback.query.data)
+    if resolved is None:
+        return False
+    route, handler, admin_only, callback.arg = resolved
+    if admin_only and not is_admin:
+        return True
+
+    counters = stats.get(route)
+    if counters is None:
+        counters = stats[route] = {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+    started = time.perf_counter()
+    failed = True
+    try:
+        with logs.context(route=route):
+            await handler(update, context, callback)
+        failed = False
+    except Exception:
+        counters['errors'] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        counters['calls'] += 1
+        counters['total'] += elapsed
+        counters['max'] = max(counters['max'], elapsed)
+        if metrics.ENABLED:
+            metrics.ROUTES.observe(route, elapsed, failed)
+    return True
@@ -0,0 +1,601 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from records import User, Deal, DealStatus, Conversation
+
+# Подключение к базе данных
+DB_NAME = 'bot_data.db'
+
+# Размер кэша подготовленных выражений sqlite3 на одно соединение
+STATEMENT_CACHE_SIZE = 128
+
+# Денежные суммы хранятся в базе целым числом минимальных единиц (1e-9, как нанотоны у TON),
+# поэтому сложение и сравнение балансов в SQL точные. В коде бота суммы - float в основных единицах,
+# перевод выполняется только здесь, на границе с базой.
+MINOR_UNITS = 10 ** 9
+
+# Счёт журнала переводов для денег, которые приходят извне и уходят наружу
+# (оплата сделки админом, ручное изменение баланса). user_id в Telegram всегда больше нуля.
+SYSTEM_ACCOUNT = 0
+
+# Идентификатор процесса в журнале изменений: свои изменения процесс не применяет повторно
+ORIGIN = f"{socket.gethostname()}:{os.getpid()}"
+
+# SQL-запросы держим константами, чтобы sqlite3 переиспользовал подготовленные выражения
+# Баланс существующего пользователя меняется только через settle_deal и set_user_stats,
+# поэтому сохранение записи его не перезаписывает
+SQL_SAVE_USER = '''
+    INSERT INTO users (user_id, wallet, balance, lang)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        wallet = excluded.wallet,
+        lang = excluded.lang
+'''
+SQL_ENSURE_USER = '''
+    INSERT OR IGNORE INTO users (user_id, wallet, balance, lang)
+    VALUES (?, '', 0, 'ru')
+'''
+SQL_DEBIT_USER = 'UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?'
+SQL_CREDIT_SELLER = 'UPDATE users SET balance = balance + ? WHERE user_id = ?'
+SQL_SET_BALANCE = 'UPDATE users SET balance = ? WHERE user_id = ?'
+# Журнал переводов: любое изменение users.balance сопровождается записью в той же транзакции
+SQL_INSERT_TRANSFER = '''
+    INSERT INTO ledger (created_at, kind, reference, from_account, to_account, amount)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+# Ручная установка баланса записывается переводом разницы с системного счёта или на него
+SQL_INSERT_ADJUSTMENT = f'''
+    INSERT INTO ledger (created_at, kind, reference, from_account, to_account, amount)
+    SELECT :now, 'adjustment', :reference,
+           CASE WHEN :balance > balance THEN {SYSTEM_ACCOUNT} ELSE user_id END,
+           CASE WHEN :balance > balance THEN user_id ELSE {SYSTEM_ACCOUNT} END,
+           ABS(:balance - balance)
+    FROM users
+    WHERE user_id = :user_id AND balance != :balance
+'''
+SQL_LAST_SNAPSHOT = 'SELECT id, ledger_id FROM balance_snapshots ORDER BY id DESC LIMIT 1'
+SQL_LAST_LEDGER_ID = 'SELECT COALESCE(MAX(id), 0) FROM ledger'
+SQL_LAST_SNAPSHOT_TIME = 'SELECT MAX(created_at) FROM balance_snapshots'
+SQL_INSERT_SNAPSHOT = 'INSERT INTO balance_snapshots (ledger_id, created_at) VALUES (?, ?)'
+# Новый снимок = предыдущий снимок + записи журнала после него
+SQL_FILL_SNAPSHOT = '''
+    INSERT INTO balance_snapshot_entries (snapshot_id, account, balance)
+    SELECT :snapshot_id, account, SUM(delta) FROM (
+        SELECT account, balance AS delta FROM balance_snapshot_entries WHERE snapshot_id = :previous_id
+        UNION ALL
+        SELECT to_account, amount FROM ledger WHERE id > :after AND id <= :until
+        UNION ALL
+        SELECT from_account, -amount FROM ledger WHERE id > :after AND id <= :until
+    )
+    GROUP BY account
+    HAVING SUM(delta) != 0
+'''
+SQL_SNAPSHOT_MISMATCHES = '''
+    SELECT users.user_id, users.balance, COALESCE(entries.balance, 0) FROM users
+    LEFT JOIN balance_snapshot_entries AS entries
+        ON entries.snapshot_id = ? AND entries.account = users.user_id
+    WHERE users.balance != COALESCE(entries.balance, 0)
+'''
+SQL_PURGE_SNAPSHOT_ENTRIES = '''
+    DELETE FROM balance_snapshot_entries
+    WHERE snapshot_id NOT IN (SELECT id FROM balance_snapshots ORDER BY id DESC LIMIT ?)
+'''
+SQL_PURGE_SNAPSHOTS = '''
+    DELETE FROM balance_snapshots
+    WHERE id NOT IN (SELECT id FROM balance_snapshots ORDER BY id DESC LIMIT ?)
+'''
+# Число успешных сделок продавца - счётчик в seller_stats, который обновляется при каждом расчёте
+SQL_COUNT_SUCCESSFUL_DEAL = '''
+    INSERT INTO seller_stats (seller_id, successful_deals, volume)
+    VALUES (?, 1, ?)
+    ON CONFLICT(seller_id) DO UPDATE SET
+        successful_deals = successful_deals + 1,
+        volume = volume + excluded.volume
+'''
+SQL_SET_SUCCESSFUL_DEALS = '''
+    INSERT INTO seller_stats (seller_id, successful_deals)
+    VALUES (?, ?)
+    ON CONFLICT(seller_id) DO UPDATE SET
+        successful_deals = excluded.successful_deals
+'''
+SQL_GET_USER_STATS = '''
+    SELECT users.balance, COALESCE(seller_stats.successful_deals, 0)
+    FROM users LEFT JOIN seller_stats ON seller_stats.seller_id = users.user_id
+    WHERE users.user_id = ?
+'''
+# UPSERT вместо INSERT OR REPLACE сохраняет rowid сделки, по которому идёт постраничный просмотр
+SQL_SAVE_DEAL = '''
+    INSERT INTO deals (deal_id, amount, description, seller_id, buyer_id, created_at, status, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(deal_id) DO UPDATE SET
+        amount = excluded.amount,
+        description = excluded.description,
+        seller_id = excluded.seller_id,
+        buyer_id = excluded.buyer_id,
+        created_at = excluded.created_at,
+        status = excluded.status,
+        updated_at = excluded.updated_at
+'''
+SQL_DELETE_DEAL = 'DELETE FROM deals WHERE deal_id = ?'
+SQL_LOAD_USERS = '''
+    SELECT users.user_id, users.wallet, users.balance, COALESCE(seller_stats.successful_deals, 0), users.lang
+    FROM users LEFT JOIN seller_stats ON seller_stats.seller_id = users.user_id
+'''
+SQL_LOAD_USER = SQL_LOAD_USERS + ' WHERE users.user_id = ?'
+SQL_LOAD_DEALS = 'SELECT deal_id, amount, description, seller_id, buyer_id, created_at, status FROM deals'
+SQL_LOAD_DEAL = SQL_LOAD_DEALS + ' WHERE deal_id = ?'
+# Постраничный просмотр сделок по ключу (created_at, rowid), использует индекс idx_deals_created_at
+SQL_DEALS_PAGE_AFTER = '''
+    SELECT rowid, deal_id, amount, description, seller_id, buyer_id, created_at, status FROM deals
+    WHERE (created_at, rowid) > (?, ?)
+    ORDER BY created_at, rowid
+    LIMIT ?
+'''
+SQL_DEALS_PAGE_BEFORE = '''
+    SELECT rowid, deal_id, amount, description, seller_id, buyer_id, created_at, status FROM deals
+    WHERE (created_at, rowid) < (?, ?)
+    ORDER BY created_at DESC, rowid DESC
+    LIMIT ?
+'''
+SQL_ADD_ADMIN = 'INSERT OR IGNORE INTO admins (user_id) VALUES (?)'
+SQL_REMOVE_ADMIN = 'DELETE FROM admins WHERE user_id = ?'
+SQL_GET_ADMINS = 'SELECT user_id FROM admins'
+# Каждая запись настроек получает новую версию, на единицу больше максимальной в таблице,
+# поэтому MAX(version) меняется при любом изменении настроек
+SQL_SET_CONFIG = '''
+    INSERT INTO config (key, value, version)
+    VALUES (?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM config))
+    ON CONFLICT(key) DO UPDATE SET
+        value = excluded.value,
+        version = excluded.version
+'''
+SQL_LOAD_CONFIG = 'SELECT key, value FROM config'
+SQL_CONFIG_VERSION = 'SELECT COALESCE(MAX(version), 0) FROM config'
+SQL_SAVE_USERNAME = '''
+    INSERT OR REPLACE INTO usernames (user_id, username, updated_at)
+    VALUES (?, ?, ?)
+'''
+SQL_SAVE_CONVERSATION = '''
+    INSERT OR REPLACE INTO conversations (user_id, state, amount, updated_at)
+    VALUES (?, ?, ?, ?)
+'''
+SQL_DELETE_CONVERSATION = 'DELETE FROM conversations WHERE user_id = ?'
+SQL_LOAD_CONVERSATION = 'SELECT state, amount, updated_at FROM conversations WHERE user_id = ?'
+SQL_PURGE_CONVERSATIONS = 'DELETE FROM conversations WHERE updated_at < ?'
+SQL_GET_USERNAME = 'SELECT username, updated_at FROM usernames WHERE user_id = ?'
+SQL_PUBLISH_CHANGE = 'INSERT INTO changes (origin, kind, key, created_at) VALUES (?, ?, ?, ?)'
+SQL_CHANGES_SINCE = 'SELECT id, origin, kind, key FROM changes WHERE id > ? ORDER BY id LIMIT ?'
+SQL_LAST_CHANGE_ID = 'SELECT COALESCE(MAX(id), 0) FROM changes'
+SQL_PURGE_CHANGES = 'DELETE FROM changes WHERE created_at < ?'
+# Завершённая сделка переносится в историю; deal_history только пополняется
+SQL_ARCHIVE_DEAL = '''
+    INSERT INTO deal_history (deal_id, amount, description, seller_id, buyer_id, status, created_at, closed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_DEAL_CLOSED = 'SELECT 1 FROM deal_history WHERE deal_id = ?'
+# Старейшие сделки без покупателя; использует индекс idx_deals_status_created_at
+SQL_SELECT_EXPIRED_DEAL_IDS = '''
+    SELECT deal_id FROM deals
+    WHERE status = 'open' AND created_at < ?
+    ORDER BY created_at
+    LIMIT ?
+'''
+# Сделка, если она всё ещё без покупателя и просрочена
+SQL_SELECT_EXPIRED_DEAL = '''
+    SELECT deal_id, amount, description, seller_id, buyer_id, created_at FROM deals
+    WHERE deal_id = ? AND status = 'open' AND created_at < ?
+'''
+SQL_LOAD_MEDIA = 'SELECT source, fingerprint, file_id FROM media'
+SQL_SAVE_MEDIA = 'INSERT OR REPLACE INTO media (source, fingerprint, file_id, updated_at) VALUES (?, ?, ?, ?)'
+SQL_DELETE_MEDIA = 'DELETE FROM media WHERE source = ?'
+SQL_INSERT_SETTLEMENT = '''
+    INSERT OR IGNORE INTO settlements (idempotency_key, deal_id, buyer_id, seller_id, amount, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Долгоживущие соединения: по одному на поток
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+# Отдельный поток-писатель: обращения к диску из async-обработчиков выполняются в нём,
+# чтобы медленный диск не останавливал event loop
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+        # WAL позволяет читать во время записи, synchronous=NORMAL убирает fsync на каждый commit
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        return _writer
+
+
+async def run_async(func, *args):
+    # Выполняет синхронную операцию с базой в потоке-писателе
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_writer(), func, *args)
+
+
+def close_all():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.shutdown(wait=True)  # Дожидаемся завершения незаписанных операций
+            _writer = None
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+    _local.__dict__.pop('conn', None)
+
+
+def to_minor(amount):
+    return None if amount is None else round(amount * MINOR_UNITS)
+
+
+def from_minor(value):
+    return None if value is None else value / MINOR_UNITS
+
+
+def _user_row(user_id, user):
+    return (
+        user_id,
+        user.wallet,
+        to_minor(user.balance),
+        user.lang,
+    )
+
+
+def _deal_row(deal_id, deal):
+    return (
+        deal_id,
+        to_minor(deal.amount),
+        deal.description,
+        deal.seller_id,
+        deal.buyer_id,
+        deal.created_at,
+        deal.status,
+        int(time.time()),
+    )
+
+
+def user_from_row(row):
+    _, wallet, balance, successful_deals, lang = row
+    return User(wallet, from_minor(balance), successful_deals, lang or 'ru')  # По умолчанию язык - русский
+
+
+def deal_from_row(row):
+    _, amount, description, seller_id, buyer_id, created_at, status = row
+    return Deal(from_minor(amount), description, seller_id, buyer_id, created_at or 0, status)
+
+
+def load_user(user_id):
+    row = get_connection().execute(SQL_LOAD_USER, (user_id,)).fetchone()
+    return user_from_row(row) if row else None
+
+
+def load_deal(deal_id):
+    row = get_connection().execute(SQL_LOAD_DEAL, (deal_id,)).fetchone()
+    return deal_from_row(row) if row else None
+
+
+def save_user(user_id, user):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_SAVE_USER, _user_row(user_id, user))
+
+
+def save_deal(deal_id, deal):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_SAVE_DEAL, _deal_row(deal_id, deal))
+
+
+def delete_deal(deal_id):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_DELETE_DEAL, (deal_id,))
+
+
+# ------------------------------
+#  Настройки (валюта, список админов)
+# ------------------------------
+# Значения лежат в таблице config, список админов - в таблице admins. Изменение админов
+# переписывает запись 'admins' в config, чтобы у неё тоже сменилась версия.
+# Все функции записи возвращают свежий снимок (версия, {ключ: значение}, [админы]).
+
+def load_config():
+    conn = get_connection()
+    # Читаем одной транзакцией, чтобы версия соответствовала значениям
+    with conn:
+        conn.execute('BEGIN')
+        version = conn.execute(SQL_CONFIG_VERSION).fetchone()[0]
+        values = dict(conn.execute(SQL_LOAD_CONFIG))
+        admins = [row[0] for row in conn.execute(SQL_GET_ADMINS)]
+    return version, values, admins
+
+
+def config_version():
+    return get_connection().execute(SQL_CONFIG_VERSION).fetchone()[0]
+
+
+def set_config(key, value):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_SET_CONFIG, (key, value))
+    return load_config()
+
+
+def add_admin(user_id):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_ADD_ADMIN, (user_id,))
+        conn.execute(SQL_SET_CONFIG, ('admins', None))
+    return load_config()
+
+
+def remove_admin(user_id):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_REMOVE_ADMIN, (user_id,))
+        conn.execute(SQL_SET_CONFIG, ('admins', None))
+    return load_config()
+
+
+def _user_stats(conn, user_id):
+    balance, successful_deals = conn.execute(SQL_GET_USER_STATS, (user_id,)).fetchone()
+    return from_minor(balance), successful_deals
+
+
+def set_user_stats(user_id, balance=None, successful_deals=None, reference=None, publish=False):
+    # Явная установка баланса и/или счётчика сделок (команды админа); возвращает новые значения.
+    # Изменение баланса записывается в журнал переводов, reference - кто его сделал.
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_ENSURE_USER, (user_id,))
+        if balance is not None:
+            balance = to_minor(balance)
+            conn.execute(SQL_INSERT_ADJUSTMENT, {
+                'now': int(time.time()), 'reference': reference, 'balance': balance, 'user_id': user_id
+            })
+            conn.execute(SQL_SET_BALANCE, (balance, user_id))
+        if successful_deals is not None:
+            conn.execute(SQL_SET_SUCCESSFUL_DEALS, (user_id, successful_deals))
+        if publish:
+            _publish(conn, 'user', [user_id])
+        return _user_stats(conn, user_id)
+
+
+def get_deals_page(after=None, before=None, limit=10):
+    # Возвращает (строки страницы, есть ли ещё сделки в направлении листания).
+    # after/before - курсор (created_at, rowid) последней/первой сделки соседней страницы.
+    conn = get_connection()
+    if before is not None:
+        rows = conn.execute(SQL_DEALS_PAGE_BEFORE, (*before, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+    else:
+        rows = conn.execute(SQL_DEALS_PAGE_AFTER, (*(after or (-1, -1)), limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    return [(rowid, deal_id, from_minor(amount), *rest) for rowid, deal_id, amount, *rest in rows], has_more
+
+
+def load_conversation(user_id):
+    row = get_connection().execute(SQL_LOAD_CONVERSATION, (user_id,)).fetchone()
+    if row is None:
+        return None
+    state, amount, updated_at = row
+    return Conversation(state, from_minor(amount), updated_at)
+
+
+def purge_conversations(older_than):
+    # Удаляет состояния диалогов, не обновлявшиеся с older_than; возвращает число удалённых
+    conn = get_connection()
+    with conn:
+        return conn.execute(SQL_PURGE_CONVERSATIONS, (older_than,)).rowcount
+
+
+def load_media():
+    return get_connection().execute(SQL_LOAD_MEDIA).fetchall()
+
+
+def save_media(source, fingerprint, file_id):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_SAVE_MEDIA, (source, fingerprint, file_id, int(time.time())))
+
+
+def delete_media(source):
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_DELETE_MEDIA, (source,))
+
+
+def get_username(user_id):
+    conn = get_connection()
+    return conn.execute(SQL_GET_USERNAME, (user_id,)).fetchone()
+
+
+# ------------------------------
+#  Журнал изменений для нескольких процессов
+# ------------------------------
+# Каждая запись говорит, что ключ kind/key изменён процессом origin; остальные процессы
+# сбрасывают у себя кэш этого ключа.
+
+def _publish(conn, kind, keys):
+    now = time.time()
+    conn.executemany(SQL_PUBLISH_CHANGE, [(ORIGIN, kind, str(key), now) for key in keys])
+
+
+def publish_change(kind, key):
+    conn = get_connection()
+    with conn:
+        _publish(conn, kind, [key])
+
+
+def last_change_id():
+    return get_connection().execute(SQL_LAST_CHANGE_ID).fetchone()[0]
+
+
+def changes_since(last_id, limit=1000):
+    # Возвращает (новый last_id, [(kind, key), ...] изменений других процессов)
+    rows = get_connection().execute(SQL_CHANGES_SINCE, (last_id, limit)).fetchall()
+    if not rows:
+        return last_id, []
+    return rows[-1][0], [(kind, key) for _, origin, kind, key in rows if origin != ORIGIN]
+
+
+def purge_changes(older_than):
+    conn = get_connection()
+    with conn:
+        return conn.execute(SQL_PURGE_CHANGES, (older_than,)).rowcount
+
+
+def write_batch(users, deals, deleted_deals, usernames=(), conversations=(), deleted_conversations=(), publish=False):
+    # Сбрасывает накопленные изменения одной транзакцией
+    conn = get_connection()
+    with conn:
+        if users:
+            conn.executemany(SQL_SAVE_USER, [_user_row(user_id, user) for user_id, user in users])
+        if deals:
+            conn.executemany(SQL_SAVE_DEAL, [_deal_row(deal_id, deal) for deal_id, deal in deals])
+        if deleted_deals:
+            conn.executemany(SQL_DELETE_DEAL, [(deal_id,) for deal_id in deleted_deals])
+        if usernames:
+            conn.executemany(SQL_SAVE_USERNAME, usernames)
+        if conversations:
+            conn.executemany(SQL_SAVE_CONVERSATION, [
+                (user_id, conversation.state, to_minor(conversation.amount), conversation.updated_at)
+                for user_id, conversation in conversations
+            ])
+        if deleted_conversations:
+            conn.executemany(SQL_DELETE_CONVERSATION, [(user_id,) for user_id in deleted_conversations])
+        if publish:
+            _publish(conn, 'user', [user_id for user_id, _ in users])
+            _publish(conn, 'deal', [deal_id for deal_id, _ in deals] + list(deleted_deals))
+            _publish(conn, 'conversation', [user_id for user_id, _ in conversations] + list(deleted_conversations))
+
+
+def settle_deal(idempotency_key, deal_id, deal, buyer_id, debit, publish=False):
+    # Перевод по сделке одной транзакцией: запись о расчёте, списание debit у покупателя,
+    # зачисление суммы продавцу, запись в журнале переводов, счётчик успешных сделок продавца и перенос сделки в историю.
+    # deal - копия записи из памяти: сделка могла ещё не попасть в базу из журнала.
+    # Балансы меняются относительно значений в базе, поэтому несколько процессов не затирают друг друга.
+    # Возвращает (статус, {user_id: (balance, successful_deals)}), статус - 'settled',
+    # 'insufficient', 'not_found' (сделка отменена) или 'duplicate' (сделка или ключ
+    # идемпотентности уже обработаны).
+    conn = get_connection()
+    now = int(time.time())
+    amount, debit = to_minor(deal.amount), to_minor(debit)
+    seller_id = deal.seller_id
+    with conn:
+        cursor = conn.execute(SQL_INSERT_SETTLEMENT, (idempotency_key, deal_id, buyer_id, seller_id, amount, now))
+        if cursor.rowcount == 0:
+            return 'duplicate', {}
+        if conn.execute(SQL_DEAL_CLOSED, (deal_id,)).fetchone():
+            conn.rollback()  # Сделка уже отменена
+            return 'not_found', {}
+        conn.execute(SQL_ENSURE_USER, (buyer_id,))
+        conn.execute(SQL_ENSURE_USER, (seller_id,))
+        if debit and conn.execute(SQL_DEBIT_USER, (debit, buyer_id, debit)).rowcount == 0:
+            conn.rollback()
+            return 'insufficient', {}
+        conn.execute(SQL_CREDIT_SELLER, (amount, seller_id))
+        # Админ платит без списания: деньги продавцу приходят с системного счёта
+        conn.execute(SQL_INSERT_TRANSFER, (
+            now, 'settlement', deal_id, buyer_id if debit else SYSTEM_ACCOUNT, seller_id, amount
+        ))
+        conn.execute(SQL_COUNT_SUCCESSFUL_DEAL, (seller_id, amount))
+        conn.execute(SQL_ARCHIVE_DEAL, (
+            deal_id, amount, deal.description, seller_id, buyer_id, DealStatus.PAID.value, deal.created_at, now
+        ))
+        conn.execute(SQL_DELETE_DEAL, (deal_id,))
+        if publish:
+            _publish(conn, 'user', [buyer_id, seller_id])
+            _publish(conn, 'deal', [deal_id])
+        stats = {user_id: _user_stats(conn, user_id) for user_id in (buyer_id, seller_id)}
+    return 'settled', stats
+
+
+def expired_deal_ids(older_than, limit):
+    # Не больше limit старейших сделок без покупателя, созданных раньше older_than
+    return [row[0] for row in get_connection().execute(SQL_SELECT_EXPIRED_DEAL_IDS, (older_than, limit))]
+
+
+def expire_deals(deal_ids, older_than, publish=False):
+    # Отменяет сделки из deal_ids, которые всё ещё без покупателя и созданы раньше older_than:
+    # переносит их в историю со статусом 'cancelled' одной короткой транзакцией.
+    # Возвращает [(deal_id, Deal)] отменённых сделок.
+    conn = get_connection()
+    now = int(time.time())
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')  # Статус проверяется и сделка удаляется без чужих записей между ними
+        rows = []
+        for deal_id in deal_ids:
+            row = conn.execute(SQL_SELECT_EXPIRED_DEAL, (deal_id, older_than)).fetchone()
+            if row is not None:
+                rows.append(row)
+        if not rows:
+            return []
+        conn.executemany(SQL_ARCHIVE_DEAL, [
+            (deal_id, amount, description, seller_id, buyer_id, DealStatus.CANCELLED.value, created_at, now)
+            for deal_id, amount, description, seller_id, buyer_id, created_at in rows
+        ])
+        conn.executemany(SQL_DELETE_DEAL, [(row[0],) for row in rows])
+        if publish:
+            _publish(conn, 'deal', [row[0] for row in rows])
+    return [(row[0], deal_from_row((*row, DealStatus.CANCELLED.value))) for row in rows]
+
+
+def last_snapshot_time():
+    # Время последнего снимка балансов (unix time) или None, если снимков ещё нет
+    return get_connection().execute(SQL_LAST_SNAPSHOT_TIME).fetchone()[0]
+
+
+def take_balance_snapshot(keep):
+    # Записывает остатки всех счетов по журналу переводов и сверяет их с users.balance.
+    # Хранятся последние keep снимков. Возвращает None, если журнал не изменился с прошлого
+    # снимка, иначе (id снимка, последняя учтённая запись журнала, [(user_id, баланс, по журналу)]).
+    conn = get_connection()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')  # Журнал и балансы не меняются, пока снимок не записан
+        previous = conn.execute(SQL_LAST_SNAPSHOT).fetchone()
+        previous_id, after = previous or (None, 0)
+        until = conn.execute(SQL_LAST_LEDGER_ID).fetchone()[0]
+        if previous is not None and until == after:
+            return None
+        snapshot_id = conn.execute(SQL_INSERT_SNAPSHOT, (until, int(time.time()))).lastrowid
+        conn.execute(SQL_FILL_SNAPSHOT, {
+            'snapshot_id': snapshot_id, 'previous_id': previous_id, 'after': after, 'until': until
+        })
+        mismatches = [
+            (user_id, from_minor(balance), from_minor(expected))
+            for user_id, balance, expected in conn.execute(SQL_SNAPSHOT_MISMATCHES, (snapshot_id,))
+        ]
+        conn.execute(SQL_PURGE_SNAPSHOT_ENTRIES, (keep,))
+        conn.execute(SQL_PURGE_SNAPSHOTS, (keep,))
+    return snapshot_id, until, mismatches
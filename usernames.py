@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+
+import fanout
+import outbox
+import backend
+import journal
+import storage
+
+# Кэш user_id -> username, чтобы не запрашивать get_chat у Telegram на каждое отображение.
+# Заполняется из update.effective_user каждого входящего обновления и хранится в SQLite.
+CACHE_TTL = 6 * 60 * 60  # Время жизни записи в секундах
+CACHE_SIZE = 10000  # Максимальное число записей в памяти (вытесняются давно не использованные)
+
+_cache = OrderedDict()  # {user_id: (username, updated_at)}
+stats = {'hits': 0, 'db_hits': 0, 'misses': 0}
+
+
+def _put(user_id, username, updated_at):
+    _cache[user_id] = (username, updated_at)
+    _cache.move_to_end(user_id)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def remember(user):
+    # Запоминает username пользователя из входящего обновления
+    if user is None:
+        return
+    now = time.time()
+    cached = _cache.get(user.id)
+    _put(user.id, user.username, now)
+    # В базу пишем только изменения и устаревшие записи, а не каждое обновление
+    if cached is None or cached[0] != user.username or now - cached[1] > CACHE_TTL / 2:
+        journal.mark_username(user.id, user.username, now)
+
+
+async def get_username(bot, user_id):
+    # Возвращает username пользователя: из памяти, из базы или запросом get_chat
+    now = time.time()
+    cached = _cache.get(user_id)
+    if cached is not None and now - cached[1] <= CACHE_TTL:
+        _cache.move_to_end(user_id)
+        stats['hits'] += 1
+        return cached[0]
+
+    row = await storage.run_async(backend.get().get_username, user_id)
+    if row is not None and now - row[1] <= CACHE_TTL:
+        _put(user_id, row[0], row[1])
+        stats['db_hits'] += 1
+        return row[0]
+
+    stats['misses'] += 1
+    await outbox.throttle()
+    username = (await bot.get_chat(user_id)).username
+    _put(user_id, username, now)
+    journal.mark_username(user_id, username, now)
+    return username
+
+
+async def get_usernames(bot, user_ids):
+    # Параллельно получает username для набора user_id.
+    # Пользователи, для которых запрос завершился ошибкой, в результат не попадают.
+    user_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+    results = await fanout.fan_out(lambda user_id: get_username(bot, user_id), user_ids)
+    return {
+        user_id: result
+        for user_id, result in zip(user_ids, results)
+        if not isinstance(result, Exception)
+    }
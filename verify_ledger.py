@@ -0,0 +1,115 @@
+import argparse
+import sqlite3
+import sys
+
+import storage
+
+# ------------------------------
+#  Проверка журнала переводов
+# ------------------------------
+# Офлайн-сверка: проигрывает журнал переводов (таблица ledger) и сравнивает результат
+# с балансами пользователей (users.balance) и со снимками балансов.
+# По умолчанию проверка начинается с последнего снимка; с --full журнал читается
+# с первой записи и заодно проверяются все сохранённые снимки.
+# Журнал читается порциями по --chunk-size записей, поэтому память не зависит от его длины.
+#
+#   python verify_ledger.py [--db bot_data.db] [--full] [--chunk-size 10000]
+#
+# Код возврата 0 - расхождений нет, 1 - найдены расхождения.
+
+CHUNK_SIZE = 10000
+
+SQL_LEDGER_CHUNK = '''
+    SELECT id, from_account, to_account, amount FROM ledger
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+SQL_SNAPSHOTS = 'SELECT id, ledger_id FROM balance_snapshots ORDER BY ledger_id, id'
+SQL_SNAPSHOT_ENTRIES = 'SELECT account, balance FROM balance_snapshot_entries WHERE snapshot_id = ?'
+SQL_USER_BALANCES = 'SELECT user_id, balance FROM users'
+
+
+def _format(value):
+    return f"{storage.from_minor(value)}"
+
+
+def _compare_snapshot(conn, snapshot_id, balances):
+    # Сравнивает остатки по журналу с сохранённым снимком; возвращает число расхождений
+    stored = dict(conn.execute(SQL_SNAPSHOT_ENTRIES, (snapshot_id,)))
+    mismatches = 0
+    for account in stored.keys() | {account for account, balance in balances.items() if balance}:
+        if stored.get(account, 0) != balances.get(account, 0):
+            print(f"Снимок {snapshot_id}: счёт {account} = {_format(stored.get(account, 0))}, "
+                  f"по журналу {_format(balances.get(account, 0))}")
+            mismatches += 1
+    return mismatches
+
+
+def verify(conn, full=False, chunk_size=CHUNK_SIZE):
+    # Возвращает число найденных расхождений
+    snapshots = conn.execute(SQL_SNAPSHOTS).fetchall()
+    balances = {}
+    last_id = 0
+    mismatches = 0
+    if snapshots and not full:
+        # Начинаем с последнего снимка
+        snapshot_id, last_id = snapshots[-1]
+        balances = dict(conn.execute(SQL_SNAPSHOT_ENTRIES, (snapshot_id,)))
+        print(f"Начинаем со снимка {snapshot_id} (записи журнала до {last_id})")
+        snapshots = []
+
+    entries = 0
+    while True:
+        rows = conn.execute(SQL_LEDGER_CHUNK, (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        for entry_id, from_account, to_account, amount in rows:
+            # Снимки, сделанные до этой записи, должны совпасть с уже накопленными остатками
+            while snapshots and snapshots[0][1] < entry_id:
+                mismatches += _compare_snapshot(conn, snapshots.pop(0)[0], balances)
+            balances[from_account] = balances.get(from_account, 0) - amount
+            balances[to_account] = balances.get(to_account, 0) + amount
+        last_id = rows[-1][0]
+        entries += len(rows)
+    for snapshot_id, _ in snapshots:
+        mismatches += _compare_snapshot(conn, snapshot_id, balances)
+    print(f"Проверено записей журнала: {entries}")
+
+    # Материализованные балансы пользователей
+    users = 0
+    for user_id, balance in conn.execute(SQL_USER_BALANCES):
+        users += 1
+        expected = balances.pop(user_id, 0)
+        if balance != expected:
+            print(f"Пользователь {user_id}: баланс {_format(balance)}, по журналу {_format(expected)}")
+            mismatches += 1
+    balances.pop(storage.SYSTEM_ACCOUNT, None)
+    for account, balance in balances.items():
+        if balance:
+            print(f"Счёт {account} есть в журнале ({_format(balance)}), но нет в users")
+            mismatches += 1
+    print(f"Проверено пользователей: {users}, расхождений: {mismatches}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка журнала переводов с балансами пользователей")
+    parser.add_argument('--db', default=storage.DB_NAME, help="путь к базе данных")
+    parser.add_argument('--full', action='store_true', help="проверять журнал с первой записи, а не с последнего снимка")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="записей журнала за один запрос")
+    args = parser.parse_args()
+
+    # Только чтение; одна транзакция, чтобы все порции видели одно состояние базы
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        mismatches = verify(conn, args.full, args.chunk_size)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()